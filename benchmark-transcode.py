@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import json
+import os
+import plistlib
+import shutil
+import subprocess
+import sys
+import time
+import urllib.parse
+from datetime import datetime
+from pathlib import Path
+
+import job_runner
+import music_profiles
+import transcode
+
+# Форматы синтетических исходных файлов: расширение, параметры кодирования, тип файла iTunes, битрейт.
+SOURCE_FORMATS = (
+    ('m4a', ['-c:a', 'aac', '-b:a', '256k'], 'AAC audio file', 256),
+    ('mp3', ['-c:a', 'libmp3lame', '-b:a', '320k'], 'MPEG audio file', 320),
+    ('flac', ['-c:a', 'flac'], 'FLAC audio file', 0))
+
+# Источники сигнала lavfi, {duration} заменяется длительностью трека.
+SOURCE_SIGNALS = (
+    'sine=frequency=440:sample_rate=44100:duration={duration}',
+    'anoisesrc=color=pink:amplitude=0.3:sample_rate=44100:duration={duration}',
+    'sine=frequency=1000:beep_factor=4:sample_rate=44100:duration={duration}')
+
+
+class Configuration:
+    # Каталог синтетической медиатеки, сгенерированные файлы используются повторно.
+    work_folder = Path.joinpath(Path.home(), '.cache', 'transcode-benchmark')
+
+    # Результаты запусков для сравнения между коммитами, по одной записи JSON в строке.
+    results_file = Path.joinpath(Path.home(), '.cache', 'transcode-benchmark-results.jsonl')
+
+    # Число треков и длительности треков в секундах, длительности назначаются по кругу.
+    track_count = 36
+    durations = (30, 60, 120, 240)
+
+    # Максимальное число процессов, проверяется 1, 2, 4, ... до максимального.
+    max_workers = os.cpu_count() or 1
+
+
+def get_worker_counts(max_workers):
+    worker_counts = []
+    workers = 1
+
+    while workers < max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+
+    return worker_counts + [max_workers]
+
+
+def get_source_file(configuration: Configuration, index):
+    extension = SOURCE_FORMATS[index % len(SOURCE_FORMATS)][0]
+
+    return Path.joinpath(
+        configuration.work_folder, 'iTunes Media', 'Music', f'Artist {index % 5}', f'Album {index % 6}',
+        f'Track {index + 1:03}.{extension}')
+
+
+async def generate_sources(configuration: Configuration):
+    """
+    Создает синтетические исходные файлы ffmpeg lavfi, существующие файлы не пересоздаются.
+    """
+    runner = job_runner.JobRunner(configuration.max_workers)
+    jobs = []
+
+    for index in range(configuration.track_count):
+        source_file = get_source_file(configuration, index)
+
+        if source_file.exists():
+            continue
+
+        source_file.parent.mkdir(parents=True, exist_ok=True)
+        _, codec_options, _, _ = SOURCE_FORMATS[index % len(SOURCE_FORMATS)]
+        signal = SOURCE_SIGNALS[index % len(SOURCE_SIGNALS)].format(
+            duration=configuration.durations[index % len(configuration.durations)])
+
+        argv = transcode.FFMPEG + ['-loglevel', 'error', '-f', 'lavfi', '-i', signal,
+                                   '-ac', '2', '-ar', '44100', *codec_options, '-y', source_file.as_posix()]
+        jobs.append(runner.run(argv))
+
+    print(f'Generate source files: {len(jobs)}')
+
+    for result in await asyncio.gather(*jobs):
+        if not result.ok:
+            raise RuntimeError(f'ffmpeg failed: {result.get_error()}')
+
+
+def create_library(configuration: Configuration):
+    """
+    Создает XML файл медиатеки iTunes со списками воспроизведения Avto и VA Sv.
+    """
+    tracks = {}
+
+    for index in range(configuration.track_count):
+        track_id = index + 1
+        source_file = get_source_file(configuration, index)
+        _, _, kind, bit_rate = SOURCE_FORMATS[index % len(SOURCE_FORMATS)]
+
+        tracks[str(track_id)] = {
+            'Track ID': track_id,
+            'Name': source_file.stem,
+            'Artist': source_file.parent.parent.name,
+            'Album': source_file.parent.name,
+            'Total Time': configuration.durations[index % len(configuration.durations)] * 1000,
+            'Kind': kind,
+            'Bit Rate': bit_rate,
+            'Sample Rate': 44100,
+            'Location': 'file://' + urllib.parse.quote(source_file.as_posix())}
+
+    track_ids = list(range(1, configuration.track_count + 1))
+    library = {
+        'Major Version': 1,
+        'Minor Version': 1,
+        'Tracks': tracks,
+        'Playlists': [
+            {'Name': 'Avto', 'Playlist ID': 1,
+             'Playlist Items': [{'Track ID': track_id} for track_id in track_ids[::2]]},
+            {'Name': 'VA Sv', 'Playlist ID': 2,
+             'Playlist Items': [{'Track ID': track_id} for track_id in track_ids[::3]]}]}
+
+    library_path = Path.joinpath(configuration.work_folder, 'iTunes Music Library.xml')
+
+    with library_path.open('wb') as fp:
+        plistlib.dump(library, fp)
+
+    return library_path
+
+
+def get_profiles(configuration: Configuration, workers):
+    # Профили повторяют create-avto-playlist.py и create-sv-playlist.py, результат в каталоге бенчмарка.
+    def get_settings(tag=None):
+        return transcode.TranscodeSettings(
+            transcode.LoudnessTarget(i=-20.0, lra=7.0, tp=-2.0, offset=0.0),
+            encode_options='-vn -acodec libmp3lame -ab 320k -ar 44100',
+            concurrency=workers,
+            adaptive_concurrency=False,
+            passthrough_tolerance=0.5,
+            tag=tag,
+            cache_path=Path.joinpath(configuration.work_folder, 'loudnorm-cache.sqlite'))
+
+    return [
+        music_profiles.ExportProfile(
+            ['Avto'], Path.joinpath(configuration.work_folder, 'out', 'Avto Music'), get_settings()),
+        music_profiles.ExportProfile(
+            ['Avto', 'VA Sv'], Path.joinpath(configuration.work_folder, 'out', 'VA Sv'), get_settings('VA Sv'))]
+
+
+def run_pipeline(configuration: Configuration, library_path, workers):
+    """
+    Запускает выгрузку с пустыми каталогами результата и кэшем громкости, возвращает показатели запуска.
+    """
+    shutil.rmtree(Path.joinpath(configuration.work_folder, 'out'), ignore_errors=True)
+    cache_path = Path.joinpath(configuration.work_folder, 'loudnorm-cache.sqlite')
+
+    if cache_path.exists():
+        cache_path.unlink()
+
+    log_path = Path.joinpath(configuration.work_folder, f'pipeline-{workers}.log')
+    started = time.monotonic()
+
+    # Вывод выгрузки по каждому треку записывается в журнал, чтобы не смешиваться с таблицей результатов.
+    with log_path.open('wt', encoding='utf-8') as log, contextlib.redirect_stdout(log):
+        profile_results = music_profiles.export_profiles(
+            get_profiles(configuration, workers), library_path, Path.joinpath(configuration.work_folder, 'reports'))
+
+    wall_seconds = time.monotonic() - started
+    results = [result for results in profile_results for result in results]
+    completed = sum(1 for result in results if result.ok)
+
+    return {
+        'workers': workers,
+        'tracks': completed,
+        'failed': len(results) - completed,
+        'wall_seconds': round(wall_seconds, 3),
+        'tracks_per_second': round(completed / wall_seconds, 3) if wall_seconds > 0 else 0.0}
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def get_previous_record(configuration: Configuration, record):
+    if not configuration.results_file.exists():
+        return None
+
+    previous = None
+
+    with configuration.results_file.open('rt', encoding='utf-8') as fp:
+        for line in fp:
+            candidate = json.loads(line)
+
+            # Сравниваются только запуски с той же медиатекой на той же машине.
+            if candidate['library'] == record['library'] and candidate['cpu_count'] == record['cpu_count']:
+                previous = candidate
+
+    return previous
+
+
+def print_results(record, previous):
+    base = record['runs'][0]['tracks_per_second']
+    previous_runs = {run['workers']: run for run in previous['runs']} if previous else {}
+
+    print(f'Commit: {record["commit"] or "-"}, engine: {record["engine"]}, tracks: {record["library"]["tracks"]}')
+    print('workers  wall, s  tracks/s  speedup  efficiency  previous')
+
+    for run in record['runs']:
+        speedup = run['tracks_per_second'] / base if base > 0 else 0.0
+        previous_run = previous_runs.get(run['workers'])
+        change = ''
+
+        if previous_run and previous_run['tracks_per_second'] > 0:
+            change = f'{run["tracks_per_second"] / previous_run["tracks_per_second"] - 1:+.0%} ' \
+                     f'({previous["commit"] or "-"})'
+
+        print(f'{run["workers"]:7}  {run["wall_seconds"]:7.1f}  {run["tracks_per_second"]:8.2f}  '
+              f'{speedup:7.2f}  {speedup / run["workers"]:10.0%}  {change}')
+
+
+def main(configuration: Configuration):
+    configuration.work_folder.mkdir(parents=True, exist_ok=True)
+    asyncio.run(generate_sources(configuration))
+    library_path = create_library(configuration)
+
+    record = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'cpu_count': os.cpu_count(),
+        'engine': transcode.get_default_engine(),
+        'library': {'tracks': configuration.track_count, 'durations': list(configuration.durations)},
+        'runs': []}
+
+    for workers in get_worker_counts(configuration.max_workers):
+        print(f'Run pipeline with {workers} workers ...')
+        record['runs'].append(run_pipeline(configuration, library_path, workers))
+
+    previous = get_previous_record(configuration, record)
+    print_results(record, previous)
+
+    configuration.results_file.parent.mkdir(parents=True, exist_ok=True)
+
+    with configuration.results_file.open('at', encoding='utf-8') as fp:
+        fp.write(json.dumps(record) + '\n')
+
+
+if __name__ == "__main__":
+    g_configuration = Configuration()
+
+    if len(sys.argv) > 1:
+        g_configuration.max_workers = int(sys.argv[1])
+
+    main(g_configuration)
@@ -1,180 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import plistlib
-import re
-import urllib.parse
-import shutil
-from pathlib import Path
-import subprocess
-import multiprocessing as mp
+import music_profiles
+import transcode
 
-TRACK_FIELD_TRACKS = 'Tracks'
-TRACK_FIELD_LOCATION = 'Location'
-TRACK_FIELD_ALBUM = 'Album'
-TRACK_FIELD_YEAR = 'Year'
-TRACK_FIELD_NUMBER = 'Track Number'
-TRACK_FIELD_NAME = 'Name'
-TRACK_FIELD_ARTIST = 'Artist'
+# Наименования списков воспроизведения из которых собираются треки.
+PLAYLIST_NAMES = ['Avto']
 
-remove_punctuation_map = dict((ord(char), None) for char in '\'\\/*?:"<>|')
-target_i = -20.0
-target_lra = 7.0
-target_tp = -2.0
-target_offset = 0.0
+# Каталог на SD карте автомагнитолы, который синхронизируется после выгрузки, например '/media/boo/AVTO/Music'.
+# None - файлы остаются только в ~/Downloads.
+DEVICE_FOLDER = None
 
-input_i_re = re.compile(r'\"input_i\"\s:\s\"(-?\d+.?\d+)')
-input_tp_re = re.compile(r'\"input_tp\"\s:\s\"(-?\d+.?\d+)')
-input_lra_re = re.compile(r'\"input_lra\"\s:\s\"(-?\d+.?\d+)')
-input_thresh_re = re.compile(r'\"input_thresh\"\s:\s\"(-?\d+.?\d+)')
+transcode_settings = transcode.TranscodeSettings(
+    transcode.LoudnessTarget(i=-20.0, lra=7.0, tp=-2.0, offset=0.0),
+    encode_options='-vn -acodec libmp3lame -ab 320k -ar 44100',
+    # mp3 320 кбит/с с громкостью в пределах 0.5 LU от целевой копируются без перекодирования.
+    passthrough_tolerance=0.5,
+    # Усиление для каждого трека (transcode.GAIN_TRACK) или общее для треков альбома (transcode.GAIN_ALBUM).
+    gain_mode=transcode.GAIN_TRACK)
 
-
-def get_itunes_library():
-    itunes_library_path = Path.joinpath(Path.home(), 'Music', 'iTunes', 'iTunes Music Library.xml')
-
-    with itunes_library_path.open('rb') as fp:
-        return plistlib.load(fp)
-
-
-def exec_shell(shell_command):
-    cmd = subprocess.Popen(
-        shell_command,
-        shell=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    out, err = cmd.communicate()
-
-    if not (err is None):
-        return str(err, 'utf-8')
-
-    return out.decode(encoding='utf8')
-
-
-def get_tracks_map(library):
-    result = {}
-
-    print('Process iTunes library export file')
-
-    # Берется только то, что ссылается на локальный файл.
-    drive_re = re.compile(r'file:(.*)')
-
-    for trackId, trackInfo in library[TRACK_FIELD_TRACKS].items():
-        location = urllib.parse.unquote(trackInfo[TRACK_FIELD_LOCATION])
-        match = drive_re.match(location)
-
-        if match is None:
-            continue
-
-        track = {
-            TRACK_FIELD_LOCATION: match[1],
-            TRACK_FIELD_NAME: trackInfo[TRACK_FIELD_NAME] if TRACK_FIELD_NAME in trackInfo else '',
-            TRACK_FIELD_ARTIST: trackInfo[TRACK_FIELD_ARTIST] if TRACK_FIELD_ARTIST in trackInfo else '',
-            TRACK_FIELD_ALBUM: trackInfo[TRACK_FIELD_ALBUM] if TRACK_FIELD_ALBUM in trackInfo else '',
-            TRACK_FIELD_YEAR: trackInfo[TRACK_FIELD_YEAR] if TRACK_FIELD_YEAR in trackInfo else 0,
-            TRACK_FIELD_NUMBER: trackInfo[TRACK_FIELD_NUMBER] if TRACK_FIELD_NUMBER in trackInfo else 0
-        }
-
-        result[trackId] = track
-
-    return result
-
-
-def get_avto_tracks(library, tracks_map):
-    tracks = []
-
-    for playlist in library['Playlists']:
-        playlist_name = playlist['Name']
-
-        if playlist_name != 'Avto':
-            continue
-
-        playlist_items = 'Playlist Items'
-        if not (playlist_items in playlist):
-            # Пропускаем пустые списки воспроизведения.
-            continue
-
-        for track in playlist[playlist_items]:
-            tracks.append(tracks_map[str(track['Track ID'])])
-
-    return tracks
-
-
-def get_loudnorm_parameter(parameter_reg, analyze_result):
-    match = parameter_reg.findall(analyze_result, re.M)
-    value_str = next(iter(match), None)
-
-    return value_str
-
-
-def process_track(track, out_folder):
-    source_file = Path(track[TRACK_FIELD_LOCATION])
-
-    artist = track[TRACK_FIELD_ARTIST].translate(remove_punctuation_map)
-    name = track[TRACK_FIELD_NAME].translate(remove_punctuation_map)
-
-    destination_file = Path.joinpath(
-        out_folder,
-        f'{artist} - {name}.mp3')
-
-    source_path = source_file.as_posix()
-
-    normalize_filter_cmd = f'-filter:a ' \
-        f'loudnorm=print_format=json' \
-        f':i={target_i}' \
-        f':lra={target_lra}' \
-        f':tp={target_tp}' \
-        f':offset={target_offset}'
-
-    # Получение информации о громкости трека.
-    analyze_cmd = f'ffmpeg -i "{source_path}" {normalize_filter_cmd} -vn -sn -dn -f null /dev/null'
-    analyze_result = exec_shell(analyze_cmd)
-    input_i = get_loudnorm_parameter(input_i_re, analyze_result)
-    input_tp = get_loudnorm_parameter(input_tp_re, analyze_result)
-    input_lra = get_loudnorm_parameter(input_lra_re, analyze_result)
-    input_thresh = get_loudnorm_parameter(input_thresh_re, analyze_result)
-
-    normalize_filter_cmd = f'-filter:a ' \
-        f'loudnorm=linear=true' \
-        f':i={target_i}' \
-        f':lra={target_lra}' \
-        f':tp={target_tp}' \
-        f':offset={target_offset}' \
-        f':measured_I={input_i}' \
-        f':measured_LRA={input_lra}' \
-        f':measured_tp={input_tp}' \
-        f':measured_thresh={input_thresh}'
-
-    if source_file.suffix == '.m4a':
-        print(f'Convert {source_path} to {destination_file.as_posix()} ...')
-        convert_cmd = f'ffmpeg -i "{source_path}"' \
-            f' -loglevel panic -y {normalize_filter_cmd} -vn -acodec libmp3lame -ab 320k -ar 44100' \
-            f' "{destination_file.as_posix()}" '
-        exec_shell(convert_cmd)
-    else:
-        print(f'Normalize volume {source_path} to {destination_file.as_posix()} ...')
-        convert_cmd = f'ffmpeg -i "{source_path}" -loglevel panic -y {normalize_filter_cmd} -vn -acodec' \
-            f' libmp3lame -ab 320k -ar 44100 "{destination_file.as_posix()}" '
-        exec_shell(convert_cmd)
-
-
-def create_playlist_files(tracks):
-    out_folder = Path.joinpath(Path.home(), 'Downloads', 'Avto Music')
-    pool = mp.Pool(mp.cpu_count())
-
-    if out_folder.exists():
-        shutil.rmtree(out_folder.as_posix())
-
-    out_folder.mkdir()
-
-    result = [pool.apply_async(process_track, [track, out_folder]) for track in tracks]
-
-    pool.close()
-    pool.join()
+avto_profile = music_profiles.ExportProfile(PLAYLIST_NAMES, 'Avto Music', transcode_settings, DEVICE_FOLDER)
 
 
 if __name__ == "__main__":
-    g_library = get_itunes_library()
-    g_tracks_map = get_tracks_map(g_library)
-    g_tracks = get_avto_tracks(g_library, g_tracks_map)
-    create_playlist_files(g_tracks)
-
+    music_profiles.export_profiles([avto_profile])
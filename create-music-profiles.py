@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import music_profiles
+import transcode
+
+# Параметры перекодирования для машины: mp3 320 кбит/с, уже подходящие mp3 копируются без перекодирования.
+CAR_TARGET = transcode.LoudnessTarget(i=-20.0, lra=7.0, tp=-2.0, offset=0.0)
+CAR_ENCODE_OPTIONS = '-vn -acodec libmp3lame -ab 320k -ar 44100'
+
+
+class Configuration:
+    # Профили выгрузки, все профили обрабатываются за один запуск: трек, нужный нескольким профилям,
+    # декодируется один раз и кодируется одним процессом ffmpeg для всех профилей.
+    profiles = [
+        music_profiles.ExportProfile(
+            ['Avto'],
+            'Avto Music',
+            transcode.TranscodeSettings(CAR_TARGET, CAR_ENCODE_OPTIONS, passthrough_tolerance=0.5)),
+        music_profiles.ExportProfile(
+            ['Avto', 'VA Sv'],
+            'VA Sv',
+            transcode.TranscodeSettings(CAR_TARGET, CAR_ENCODE_OPTIONS, passthrough_tolerance=0.5, tag='VA Sv')),
+        # Телефон: меньший битрейт и большая громкость для наушников.
+        music_profiles.ExportProfile(
+            ['Avto'],
+            'Phone Music',
+            transcode.TranscodeSettings(
+                transcode.LoudnessTarget(i=-16.0, lra=11.0, tp=-1.5, offset=0.0),
+                '-vn -acodec libmp3lame -ab 128k -ar 44100')),
+    ]
+
+
+if __name__ == "__main__":
+    music_profiles.export_profiles(Configuration.profiles)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Синхронизация каталога результата перекодирования с устройством (USB флешка, SD карта).
+Копируются только изменившиеся файлы, запись выполняется последовательно большими блоками.
+"""
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import transcode
+
+# Размер блока чтения и записи.
+BUFFER_SIZE = 8 * 1024 * 1024
+# Число прочитанных блоков в очереди записи, ограничивает расход памяти.
+QUEUE_BLOCKS = 4
+# Точность времени модификации файлов на FAT/exFAT в секундах.
+MTIME_TOLERANCE = 2.0
+
+# Состояние синхронизации на устройстве: контрольные суммы записанных файлов.
+SYNC_FILE_NAME = '.sync.json'
+
+
+class SyncResult:
+    """
+    Итоги синхронизации.
+    """
+
+    def __init__(self):
+        self.copied = 0
+        self.skipped = 0
+        self.removed = 0
+        self.bytes_copied = 0
+        self.seconds = 0.0
+
+    def get_throughput(self):
+        """
+        Скорость записи в байтах в секунду.
+        """
+        return self.bytes_copied / self.seconds if self.seconds > 0 else 0.0
+
+
+def get_mount_root(path: Path):
+    """
+    Возвращает точку монтирования файловой системы, на которой находится каталог (или находился бы, если его нет).
+    """
+    path = Path(os.path.abspath(path))
+
+    while not path.exists():
+        path = path.parent
+
+    while not os.path.ismount(path):
+        path = path.parent
+
+    return path
+
+
+def is_device_mounted(device_folder: Path, out_folder: Path):
+    """
+    Проверяет, что каталог устройства находится на подключенном устройстве: точка монтирования каталога
+    не корень и файловая система отличается от файловой системы каталога результата.
+    Каталог точки монтирования (например /media/user/CARD) существует и без карты, тогда запись шла бы на диск.
+    """
+    mount_root = get_mount_root(device_folder)
+
+    return mount_root != Path(mount_root.anchor) and mount_root.stat().st_dev != out_folder.stat().st_dev
+
+
+def is_synced(local_file: Path, device_file: Path, checksum, device_state):
+    """
+    Проверяет, что файл на устройстве совпадает с файлом результата.
+    Если известны контрольные суммы, то сравниваются они, иначе размер и время модификации.
+    """
+    if not device_file.exists():
+        return False
+
+    local_stat = local_file.stat()
+    device_stat = device_file.stat()
+
+    if device_stat.st_size != local_stat.st_size:
+        return False
+
+    if checksum is not None and device_state is not None:
+        return device_state.get('checksum') == checksum
+
+    return abs(device_stat.st_mtime - local_stat.st_mtime) <= MTIME_TOLERANCE
+
+
+def _put(blocks: queue.Queue, item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _read_blocks(files, blocks: queue.Queue, stop: threading.Event):
+    # Файлы читаются блоками по порядку, конец файла обозначается None, ошибка чтения передается в очередь.
+    try:
+        for source_file, _ in files:
+            with open(source_file, 'rb', buffering=0) as fp:
+                while True:
+                    block = fp.read(BUFFER_SIZE)
+
+                    if not block:
+                        break
+
+                    if not _put(blocks, block, stop):
+                        return
+
+            if not _put(blocks, None, stop):
+                return
+    except OSError as e:
+        _put(blocks, e, stop)
+
+
+def _finish_file(partial_file: Path, source_file: Path, destination_file: Path):
+    # Время модификации переносится с файла результата, по нему сравниваются файлы без контрольной суммы.
+    stat = source_file.stat()
+    os.utime(partial_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(partial_file, destination_file)
+
+
+def copy_files_sequential(files, fsync=True):
+    """
+    Копирует файлы одним потоком записи: запись идет последовательно, следующий блок читается,
+    пока записывается текущий. Возвращает число записанных байт.
+
+    :param files: Пары (файл результата, файл на устройстве).
+    :param fsync: Дожидаться записи каждого файла на устройство.
+    """
+    blocks = queue.Queue(QUEUE_BLOCKS)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_blocks, args=(files, blocks, stop), daemon=True)
+    reader.start()
+    bytes_copied = 0
+
+    try:
+        for source_file, destination_file in files:
+            partial_file = transcode.get_partial_file(destination_file)
+
+            with open(partial_file, 'wb', buffering=0) as fp:
+                while True:
+                    block = blocks.get()
+
+                    if block is None:
+                        break
+
+                    if isinstance(block, OSError):
+                        raise block
+
+                    view = memoryview(block)
+
+                    while view:
+                        view = view[fp.write(view):]
+
+                    bytes_copied += len(block)
+
+                if fsync:
+                    os.fsync(fp.fileno())
+
+            _finish_file(partial_file, source_file, destination_file)
+    finally:
+        stop.set()
+        reader.join()
+
+    return bytes_copied
+
+
+def copy_file(source_file: Path, destination_file: Path, fsync=True):
+    partial_file = transcode.get_partial_file(destination_file)
+
+    with open(source_file, 'rb') as source, open(partial_file, 'wb') as destination:
+        shutil.copyfileobj(source, destination, BUFFER_SIZE)
+        destination.flush()
+
+        if fsync:
+            os.fsync(destination.fileno())
+
+    _finish_file(partial_file, source_file, destination_file)
+
+    return source_file.stat().st_size
+
+
+def sync_folder(out_folder: Path, device_folder: Path, writers=1, fsync=True):
+    """
+    Синхронизирует каталог результата с каталогом на устройстве по манифесту каталога результата:
+    копируются новые и изменившиеся файлы, удаляются файлы, которых больше нет в манифесте.
+
+    :param writers: Число потоков записи, по умолчанию один, чтобы параллельная запись не фрагментировала флеш память.
+    :return: SyncResult.
+    """
+    manifest = transcode.OutputManifest(out_folder)
+    device_folder.mkdir(parents=True, exist_ok=True)
+    state_file = Path.joinpath(device_folder, SYNC_FILE_NAME)
+    state = {}
+
+    if state_file.exists():
+        with state_file.open('rt', encoding='utf-8') as fp:
+            state = json.load(fp)
+
+    result = SyncResult()
+    files = []
+
+    for destination_name, entry in sorted(manifest.entries.items()):
+        local_file = Path.joinpath(out_folder, destination_name)
+        device_file = Path.joinpath(device_folder, destination_name)
+
+        if not local_file.exists():
+            continue
+
+        if is_synced(local_file, device_file, entry.get('checksum'), state.get(destination_name)):
+            # Совпавший по размеру и времени файл тоже записывается в состояние, иначе его нельзя будет удалить.
+            state[destination_name] = {'checksum': entry.get('checksum')}
+            result.skipped += 1
+        else:
+            files.append((local_file, device_file))
+
+    # Удаляются только файлы, записанные синхронизацией, остальные файлы на устройстве не трогаются.
+    for destination_name in list(state):
+        if destination_name in manifest.entries:
+            continue
+
+        device_file = Path.joinpath(device_folder, destination_name)
+
+        if device_file.exists():
+            print(f'Remove {device_file.as_posix()}')
+            device_file.unlink()
+
+        del state[destination_name]
+        result.removed += 1
+
+    started = time.monotonic()
+
+    if writers > 1:
+        with ThreadPoolExecutor(max_workers=writers) as executor:
+            result.bytes_copied = sum(executor.map(lambda pair: copy_file(*pair, fsync), files))
+    else:
+        result.bytes_copied = copy_files_sequential(files, fsync)
+
+    result.seconds = time.monotonic() - started
+    result.copied = len(files)
+
+    for local_file, _ in files:
+        state[local_file.name] = {'checksum': manifest.entries[local_file.name].get('checksum')}
+
+    temp_file = state_file.with_name(state_file.name + '.tmp')
+
+    with temp_file.open('wt', encoding='utf-8') as fp:
+        json.dump(state, fp, ensure_ascii=False, indent=1, sort_keys=True)
+
+    os.replace(temp_file, state_file)
+
+    print(f'Synced {out_folder.as_posix()} to {device_folder.as_posix()}: copied {result.copied} '
+          f'({result.bytes_copied / 1024 / 1024:.1f} MB in {result.seconds:.1f} s, '
+          f'{result.get_throughput() / 1024 / 1024:.1f} MB/s), skipped {result.skipped}, removed {result.removed}')
+
+    return result
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Измерение громкости по EBU R128 (ITU-R BS.1770) для PCM данных: интегральная громкость,
+диапазон громкости (LRA) и истинный пик. Требуются numpy и scipy.
+"""
+import math
+
+import numpy as np
+from scipy import signal
+
+# Длительность сегмента, из сегментов собираются блоки 400 мс (интегральная громкость) и 3 с (LRA).
+SEGMENT_SECONDS = 0.1
+MOMENTARY_SEGMENTS = 4
+SHORT_TERM_SEGMENTS = 30
+
+ABSOLUTE_GATE = -70.0
+INTEGRATED_RELATIVE_GATE = -10.0
+LRA_RELATIVE_GATE = -20.0
+
+# Передискретизация для определения истинного пика.
+TRUE_PEAK_OVERSAMPLING = 4
+# Перекрытие соседних фрагментов при передискретизации в исходных отсчетах, не меньше половины длины
+# фильтра resample_poly (10 отсчетов для передискретизации в 4 раза): иначе фильтр дополняет края
+# фрагмента нулями и на границах фрагментов появляются ложные пики.
+TRUE_PEAK_OVERLAP = 32
+
+# Размер обрабатываемого за раз фрагмента в сегментах, ограничивает расход памяти.
+CHUNK_SEGMENTS = 100
+
+# Минимальное значение громкости, которое возвращается для тишины.
+SILENCE = -99.0
+
+
+def get_k_weighting_filters(sample_rate):
+    """
+    Возвращает коэффициенты двух биквадратных фильтров K-взвешивания для произвольной частоты дискретизации
+    (пересчет аналоговых прототипов как в libebur128).
+    """
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = math.pow(10.0, gain / 20.0)
+    vb = math.pow(vh, 0.4996667741545416)
+    a0 = 1.0 + k / q + k * k
+
+    shelf_b = [(vh + vb * k / q + k * k) / a0, 2.0 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]
+    shelf_a = [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1.0 + k / q + k * k
+
+    highpass_b = [1.0, -2.0, 1.0]
+    highpass_a = [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+
+    return (shelf_b, shelf_a), (highpass_b, highpass_a)
+
+
+def _power_to_loudness(power):
+    with np.errstate(divide='ignore'):
+        return -0.691 + 10.0 * np.log10(power)
+
+
+def _loudness_to_power(loudness):
+    return np.power(10.0, (loudness + 0.691) / 10.0)
+
+
+def _get_block_powers(segment_powers, block_segments):
+    """
+    Средняя мощность блоков длиной block_segments сегментов с шагом в один сегмент.
+    """
+    if len(segment_powers) < block_segments:
+        return np.empty(0)
+
+    cumulative = np.concatenate(([0.0], np.cumsum(segment_powers)))
+
+    return (cumulative[block_segments:] - cumulative[:-block_segments]) / block_segments
+
+
+class LoudnessResult:
+    def __init__(self, integrated, true_peak, loudness_range, threshold):
+        self.integrated = integrated
+        self.true_peak = true_peak
+        self.loudness_range = loudness_range
+        self.threshold = threshold
+
+
+def measure(samples, sample_rate):
+    """
+    Измеряет громкость PCM данных.
+
+    :param samples: Массив (отсчеты, каналы) float32, например np.memmap файла f32le.
+    :param sample_rate: Частота дискретизации.
+    """
+    (shelf_b, shelf_a), (highpass_b, highpass_a) = get_k_weighting_filters(sample_rate)
+    channels = samples.shape[1]
+
+    segment_length = int(round(sample_rate * SEGMENT_SECONDS))
+    chunk_length = segment_length * CHUNK_SEGMENTS
+
+    shelf_state = np.zeros((max(len(shelf_a), len(shelf_b)) - 1, channels))
+    highpass_state = np.zeros((max(len(highpass_a), len(highpass_b)) - 1, channels))
+
+    segment_powers = []
+    peak = 0.0
+
+    # Данные обрабатываются фрагментами, состояние фильтров переносится между фрагментами.
+    for start in range(0, len(samples), chunk_length):
+        chunk = np.asarray(samples[start:start + chunk_length], dtype=np.float64)
+
+        filtered, shelf_state = signal.lfilter(shelf_b, shelf_a, chunk, axis=0, zi=shelf_state)
+        filtered, highpass_state = signal.lfilter(highpass_b, highpass_a, filtered, axis=0, zi=highpass_state)
+
+        # Неполный последний сегмент в измерении громкости не участвует.
+        whole_segments = len(filtered) // segment_length
+        squares = np.square(filtered[:whole_segments * segment_length])
+        # Все каналы стерео имеют весовой коэффициент 1.
+        segment_powers.append(squares.reshape(whole_segments, segment_length, channels).mean(axis=1).sum(axis=1))
+
+        overlap_start = max(start - TRUE_PEAK_OVERLAP, 0)
+        extended = np.asarray(samples[overlap_start:start + chunk_length + TRUE_PEAK_OVERLAP], dtype=np.float64)
+        offset = (start - overlap_start) * TRUE_PEAK_OVERSAMPLING
+        # Отсчеты перекрытия только задают состояние фильтра, пик ищется по отсчетам самого фрагмента.
+        oversampled = signal.resample_poly(extended, TRUE_PEAK_OVERSAMPLING, 1, axis=0)
+        oversampled = oversampled[offset:offset + len(chunk) * TRUE_PEAK_OVERSAMPLING]
+        peak = max(peak, float(np.max(np.abs(oversampled), initial=0.0)), float(np.max(np.abs(chunk), initial=0.0)))
+
+    segment_powers = np.concatenate(segment_powers) if segment_powers else np.empty(0)
+
+    integrated, threshold = _get_integrated_loudness(_get_block_powers(segment_powers, MOMENTARY_SEGMENTS))
+    loudness_range = _get_loudness_range(_get_block_powers(segment_powers, SHORT_TERM_SEGMENTS))
+    true_peak = 20.0 * math.log10(peak) if peak > 0.0 else SILENCE
+
+    return LoudnessResult(integrated, true_peak, loudness_range, threshold)
+
+
+def _get_integrated_loudness(block_powers):
+    block_loudness = _power_to_loudness(block_powers)
+    gated_powers = block_powers[block_loudness > ABSOLUTE_GATE]
+
+    if not len(gated_powers):
+        return SILENCE, SILENCE
+
+    threshold = float(_power_to_loudness(gated_powers.mean())) + INTEGRATED_RELATIVE_GATE
+    gated_powers = gated_powers[_power_to_loudness(gated_powers) > threshold]
+
+    if not len(gated_powers):
+        return SILENCE, threshold
+
+    return float(_power_to_loudness(gated_powers.mean())), threshold
+
+
+def _get_loudness_range(block_powers):
+    block_loudness = _power_to_loudness(block_powers)
+    gated_loudness = block_loudness[block_loudness > ABSOLUTE_GATE]
+
+    if not len(gated_loudness):
+        return 0.0
+
+    threshold = float(_power_to_loudness(_loudness_to_power(gated_loudness).mean())) + LRA_RELATIVE_GATE
+    gated_loudness = gated_loudness[gated_loudness > threshold]
+
+    if not len(gated_loudness):
+        return 0.0
+
+    low, high = np.percentile(gated_loudness, [10, 95])
+
+    return float(high - low)
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import plistlib
+import hashlib
+import json
+import os
 import re
-import urllib.parse
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from operator import itemgetter
+from operator import attrgetter
+
+import itunes_library
 
 # Наименования исключаемых умных списков воспроизведения.
 EXCEPT_PLAYLIST_NAMES = {
@@ -21,70 +24,83 @@ EXCEPT_PLAYLIST_NAMES = {
     'Медиатека',
     'Покупки'}
 
-TRACK_FIELD_TRACKS = 'Tracks'
-TRACK_FIELD_LOCATION = 'Location'
-TRACK_FIELD_ALBUM = 'Album'
-TRACK_FIELD_YEAR = 'Year'
-TRACK_FIELD_NUMBER = 'Track Number'
-TRACK_FIELD_ID = 'Track ID'
-
-
-def get_itunes_library():
-    itunes_library_path = Path.joinpath(Path.home(), "Music", "iTunes", "iTunes Music Library.xml")
+# Файл с описанием списков воспроизведения в виде запросов к медиатеке, формат описан в itunes_library.TrackIndex.
+# Пример: {"90-е": {"year": {"from": 1990, "to": 1999}}, "Rock": {"genre": ["Rock", "Hard Rock"]}}
+QUERY_PLAYLISTS_PATH = Path.joinpath(Path.home(), 'Music', 'iTunes', 'Query Playlists.json')
 
-    with itunes_library_path.open('rb') as fp:
-        return plistlib.load(fp)
 
+class DeviceProfile:
+    """
+    Формат списков воспроизведения для конкретного плеера.
+    """
 
-def get_tracks_map(library):
-    result = {}
-
-    # Берется только то, что ссылается на локальный файл.
-    drive_re = re.compile(r'file:\/\/\/(\w+\/)+((Music|iTunes Media)+.*)')
+    def __init__(self, name, out_folder, path_prefix, separator, encoding='utf-8',
+                 sort_fields=('year', 'album', 'number')):
+        self.name = name
+        self.out_folder = out_folder
+        self.path_prefix = path_prefix
+        self.separator = separator
+        self.encoding = encoding
+        self.sort_fields = sort_fields
 
-    for trackId, trackInfo in library[TRACK_FIELD_TRACKS].items():
+    def get_track_path(self, track):
+        return self.path_prefix + track.location.replace('/', self.separator)
 
-        if TRACK_FIELD_LOCATION not in trackInfo:
-            continue
 
-        location = urllib.parse.unquote(trackInfo[TRACK_FIELD_LOCATION])
-        match = drive_re.match(location)
+class Configuration:
+    # Плееры для которых создаются списки воспроизведения, все списки создаются за одно чтение медиатеки.
+    profiles = [
+        # Fiio X1 II использует Windows пути (проверить возможно ли использование posix пути).
+        DeviceProfile(
+            'Fiio X1 II',
+            Path.joinpath(Path.home(), 'Downloads', 'Playlists'),
+            path_prefix='TF1:\\',
+            separator='\\'),
+        # Пример профиля для телефона с posix путями и сортировкой по исполнителю:
+        # DeviceProfile(
+        #     'Phone',
+        #     Path.joinpath(Path.home(), 'Downloads', 'Phone Playlists'),
+        #     path_prefix='/storage/emulated/0/',
+        #     separator='/',
+        #     sort_fields=('artist', 'year', 'album', 'number')),
+    ]
+
+
+def get_tracks_map(tracks):
+    result = itunes_library.get_tracks_map(tracks)
+
+    # Берутся только файлы из папок медиатеки.
+    drive_re = re.compile(r'\/(\w+\/)+((Music|iTunes Media)+.*)')
+
+    for track_id, track in list(result.items()):
+        match = drive_re.match(track.location)
 
         if match is None:
+            del result[track_id]
             continue
 
-        # Fiio X1 II использует Windows пути (проверить возможно ли использование posix пути).
-        track = {
-            TRACK_FIELD_LOCATION: 'TF1:\\' + match[2].replace('/', '\\'),
-            TRACK_FIELD_ALBUM: trackInfo[TRACK_FIELD_ALBUM] if TRACK_FIELD_ALBUM in trackInfo else '',
-            TRACK_FIELD_YEAR: trackInfo[TRACK_FIELD_YEAR] if TRACK_FIELD_YEAR in trackInfo else 0,
-            TRACK_FIELD_NUMBER: trackInfo[TRACK_FIELD_NUMBER] if TRACK_FIELD_NUMBER in trackInfo else 0
-        }
-
-        result[trackId] = track
+        # Путь относительно папки медиатеки, путь на устройстве формируется профилем плеера.
+        track.location = match[2]
 
     return result
 
 
-def get_smart_playlist_map(library, tracks_map):
+def get_smart_playlist_map(playlists, tracks_map):
     result = {}
 
-    for playlist in library['Playlists']:
+    for playlist in playlists:
         playlist_name = playlist['Name']
 
         if playlist_name in EXCEPT_PLAYLIST_NAMES:
             # Пропускаем стандартные списки воспроизведения.
             continue
 
-        playlist_items = 'Playlist Items'
-        if not (playlist_items in playlist):
+        if itunes_library.PLAYLIST_FIELD_ITEMS not in playlist:
             # Пропускаем пустые списки воспроизведения.
             continue
 
         tracks = []
-        for track in playlist[playlist_items]:
-
-            track_id = str(track[TRACK_FIELD_ID])
+        for track_id in playlist[itunes_library.PLAYLIST_FIELD_ITEMS]:
 
             if track_id not in tracks_map:
                 continue
@@ -97,32 +113,94 @@ def get_smart_playlist_map(library, tracks_map):
     return result
 
 
-def create_playlist_files(playlist_map):
-    out_folder = Path.joinpath(Path.home(), "Downloads", "Playlists")
+def get_query_playlist_map(tracks_map):
+    result = {}
+
+    if not QUERY_PLAYLISTS_PATH.exists():
+        return result
+
+    with QUERY_PLAYLISTS_PATH.open('rt', encoding='utf-8') as fp:
+        queries = json.load(fp)
+
+    # Индексы строятся один раз и используются всеми запросами.
+    index = itunes_library.TrackIndex(tracks_map.values())
+
+    for playlist_name, query in queries.items():
+        tracks = index.select(query)
 
-    if out_folder.exists():
-        shutil.rmtree(out_folder.as_posix())
+        if tracks:
+            result[playlist_name] = tracks
+
+    return result
 
-    out_folder.mkdir()
+
+def get_content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_file_hash(file_path):
+    if not file_path.exists():
+        return None
+
+    return get_content_hash(file_path.read_bytes())
+
+
+def write_file_atomic(file_path, content):
+    # Запись во временный файл и переименование, чтобы на карте не остался недописанный список.
+    temp_file_path = file_path.with_name(file_path.name + '.tmp')
+    temp_file_path.write_bytes(content)
+    os.replace(temp_file_path.as_posix(), file_path.as_posix())
+
+
+def render_playlist(tracks, profile: DeviceProfile):
+    lines = ['#EXTM3U']
+    lines.extend(profile.get_track_path(track) for track in tracks)
+    lines.append('')
+
+    return '\n'.join(lines).encode(profile.encoding)
+
+
+def create_playlist_files(playlist_map, profile: DeviceProfile):
+    out_folder = profile.out_folder
+    out_folder.mkdir(parents=True, exist_ok=True)
+
+    out_playlist_filenames = set()
 
     for playlist_name, tracks in playlist_map.items():
-        # Сортировка треков в списке воспроизведения по году, альбому и номеру трека.
-        tracks.sort(key=itemgetter(TRACK_FIELD_YEAR, TRACK_FIELD_ALBUM, TRACK_FIELD_NUMBER))
+        # Сортировка треков в списке воспроизведения, по умолчанию по году, альбому и номеру трека.
+        tracks = sorted(tracks, key=attrgetter(*profile.sort_fields))
 
         playlist_name1 = re.sub(r'[^\-\d\s\w_\']+', '', playlist_name)
         out_playlist_filename = Path.joinpath(out_folder, playlist_name1).with_suffix('.m3u')
+        out_playlist_filenames.add(out_playlist_filename)
+
+        # Перезаписываются только изменившиеся списки воспроизведения.
+        content = render_playlist(tracks, profile)
+
+        if get_file_hash(out_playlist_filename) == get_content_hash(content):
+            continue
+
+        print(f'{profile.name} create:', playlist_name, ' =>', out_playlist_filename)
+        write_file_atomic(out_playlist_filename, content)
+
+    for playlist_filename in out_folder.glob('*.m3u'):
+        if playlist_filename not in out_playlist_filenames:
+            print(f'{profile.name} remove:', playlist_filename)
+            playlist_filename.unlink()
+
 
-        with out_playlist_filename.open('wt', encoding="utf-8") as outfile:
-            print('Create:', playlist_name, ' =>', out_playlist_filename)
-            outfile.write('#EXTM3U\n')
+def create_profiles_playlist_files(playlist_map, profiles):
+    # Списки воспроизведения разных плееров записываются параллельно, обычно в разные устройства.
+    with ThreadPoolExecutor(max_workers=max(len(profiles), 1)) as executor:
+        futures = [executor.submit(create_playlist_files, playlist_map, profile) for profile in profiles]
 
-            for track in tracks:
-                outfile.write(track[TRACK_FIELD_LOCATION])
-                outfile.write('\n')
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
-    g_library = get_itunes_library()
-    g_tracks_map = get_tracks_map(g_library)
-    g_smart_playlist_map = get_smart_playlist_map(g_library, g_tracks_map)
-    create_playlist_files(g_smart_playlist_map)
+    g_library = itunes_library.open_library()
+    g_tracks_map = get_tracks_map(g_library.tracks())
+    g_smart_playlist_map = get_smart_playlist_map(g_library.playlists(), g_tracks_map)
+    g_smart_playlist_map.update(get_query_playlist_map(g_tracks_map))
+    create_profiles_playlist_files(g_smart_playlist_map, Configuration.profiles)
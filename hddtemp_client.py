@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Клиент службы hddtemp: чтение температуры дисков через сокет без запуска nc.
+"""
+import socket
+import sys
+
+import hwmon_sensors
+
+HDDTEMP_HOST = 'localhost'
+HDDTEMP_PORT = 7634
+# Таймаут подключения и чтения в секундах.
+HDDTEMP_TIMEOUT = 2.0
+READ_SIZE = 4096
+
+
+def get_celsius(value, unit):
+    """
+    Возвращает температуру в градусах Цельсия или None, если hddtemp не знает температуру (SLP, UNK, NA, ERR).
+    """
+    try:
+        temperature = float(value)
+    except ValueError:
+        return None
+
+    return (temperature - 32) * 5 / 9 if unit == 'F' else temperature
+
+
+def parse_records(data):
+    """
+    Разбирает ответ hddtemp вида |/dev/sda|Модель|35|C||/dev/sdb|Модель|SLP|*|.
+
+    :return: Словарь устройство -> (модель, температура в градусах Цельсия или None).
+    """
+    disks = {}
+    data = data.strip()
+
+    if not data:
+        return disks
+
+    for record in data.strip('|').split('||'):
+        fields = record.split('|')
+
+        if len(fields) != 4:
+            continue
+
+        device, model, value, unit = fields
+        disks[device] = (model, get_celsius(value, unit))
+
+    return disks
+
+
+class HddtempClient:
+    """
+    Чтение температуры всех дисков из службы hddtemp.
+    Служба отдает все диски одним ответом и сама закрывает соединение, поэтому соединение на каждый замер новое.
+
+    :param drivetemp_fallback: Если служба недоступна, читать датчики drivetemp из sysfs.
+    :param sysfs_root: Корень sysfs для датчиков drivetemp.
+    """
+
+    def __init__(self, host=HDDTEMP_HOST, port=HDDTEMP_PORT, timeout=HDDTEMP_TIMEOUT, drivetemp_fallback=True,
+                 sysfs_root='/sys'):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.drivetemp_reader = hwmon_sensors.DrivetempReader(sysfs_root) if drivetemp_fallback else None
+
+    def receive(self):
+        chunks = []
+
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as connection:
+            while True:
+                chunk = connection.recv(READ_SIZE)
+
+                if not chunk:
+                    break
+
+                chunks.append(chunk)
+
+        return b''.join(chunks).decode('utf-8', errors='replace')
+
+    def read(self):
+        """
+        Возвращает словарь устройство -> (модель, температура в градусах Цельсия или None).
+        """
+        try:
+            return parse_records(self.receive())
+        except OSError as e:
+            if self.drivetemp_reader is None:
+                raise
+
+            print(f'hddtemp {self.host}:{self.port} is not available, read drivetemp: {e}', file=sys.stderr)
+
+            return self.drivetemp_reader.read()
+
+    def close(self):
+        if self.drivetemp_reader is not None:
+            self.drivetemp_reader.close()
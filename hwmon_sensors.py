@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Чтение датчиков температуры напрямую из sysfs (/sys/class/hwmon и /sys/class/thermal) без запуска sensors.
+Датчики находятся один раз при создании HwmonReader, затем значения читаются через заранее открытые файлы.
+"""
+import os
+import re
+from pathlib import Path
+
+TEMP_INPUT_PATTERN = re.compile(r'^temp(\d+)_input$')
+THERMAL_ZONE_PATTERN = re.compile(r'^thermal_zone(\d+)$')
+
+# Размер чтения значения датчика, значение в sysfs - целое число в миллиградусах.
+READ_SIZE = 32
+
+
+def _read_text(path: Path):
+    try:
+        return path.read_text(encoding='utf-8').strip()
+    except OSError:
+        return None
+
+
+def read_value(descriptor):
+    """
+    Читает значение датчика из открытого файла, возвращает температуру в градусах или None при ошибке чтения.
+    """
+    try:
+        return int(os.pread(descriptor, READ_SIZE, 0)) / 1000
+    except (OSError, ValueError):
+        # Драйвер может вернуть ошибку чтения для неподключенного датчика или спящего диска.
+        return None
+
+
+def _get_number(path: Path, pattern):
+    match = pattern.match(path.name)
+
+    return int(match.group(1)) if match else -1
+
+
+def discover_sensors(sysfs_root='/sys'):
+    """
+    Возвращает словарь (чип, метка) -> файл значения датчика.
+    Чип - содержимое файла name устройства hwmon, метка - содержимое tempN_label или tempN, как в выводе sensors.
+    Зоны thermal_zone добавляются как (тип зоны, tempN), где N - номер зоны этого типа, если такой метки нет
+    среди устройств hwmon: так же нумерует зоны acpitz sensors (acpitz-virtual-0).
+    """
+    sensors = {}
+    hwmon_folder = Path.joinpath(Path(sysfs_root), 'class', 'hwmon')
+
+    if hwmon_folder.is_dir():
+        for device_folder in sorted(hwmon_folder.iterdir(), key=lambda p: p.name):
+            chip = _read_text(Path.joinpath(device_folder, 'name'))
+
+            if chip is None:
+                continue
+
+            input_files = [p for p in device_folder.iterdir() if TEMP_INPUT_PATTERN.match(p.name)]
+
+            for input_file in sorted(input_files, key=lambda p: _get_number(p, TEMP_INPUT_PATTERN)):
+                number = _get_number(input_file, TEMP_INPUT_PATTERN)
+                label = _read_text(Path.joinpath(device_folder, f'temp{number}_label')) or f'temp{number}'
+                sensors.setdefault((chip, label), input_file)
+
+    thermal_folder = Path.joinpath(Path(sysfs_root), 'class', 'thermal')
+
+    if thermal_folder.is_dir():
+        zone_counts = {}
+        zone_folders = [p for p in thermal_folder.iterdir() if THERMAL_ZONE_PATTERN.match(p.name)]
+
+        for zone_folder in sorted(zone_folders, key=lambda p: _get_number(p, THERMAL_ZONE_PATTERN)):
+            zone_type = _read_text(Path.joinpath(zone_folder, 'type'))
+
+            if zone_type is None:
+                continue
+
+            zone_counts[zone_type] = zone_counts.get(zone_type, 0) + 1
+            sensors.setdefault((zone_type, f'temp{zone_counts[zone_type]}'), Path.joinpath(zone_folder, 'temp'))
+
+    return sensors
+
+
+def discover_drives(sysfs_root='/sys'):
+    """
+    Возвращает словарь устройство (/dev/sda) -> (модель, файл значения) для датчиков дисков drivetemp.
+    """
+    drives = {}
+    hwmon_folder = Path.joinpath(Path(sysfs_root), 'class', 'hwmon')
+
+    if not hwmon_folder.is_dir():
+        return drives
+
+    for device_folder in sorted(hwmon_folder.iterdir(), key=lambda p: p.name):
+        if _read_text(Path.joinpath(device_folder, 'name')) != 'drivetemp':
+            continue
+
+        # device - устройство SCSI диска, имя блочного устройства в его каталоге block.
+        block_folder = Path.joinpath(device_folder, 'device', 'block')
+
+        if not block_folder.is_dir():
+            continue
+
+        block_names = sorted(p.name for p in block_folder.iterdir())
+
+        if block_names:
+            model = _read_text(Path.joinpath(device_folder, 'device', 'model')) or ''
+            drives[f'/dev/{block_names[0]}'] = (model, Path.joinpath(device_folder, 'temp1_input'))
+
+    return drives
+
+
+class HwmonReader:
+    """
+    Чтение набора датчиков температуры.
+
+    :param sensors: Словарь ключ -> (чип, метка), например {'cpu': ('coretemp', 'Package id 0')}.
+    :param sysfs_root: Корень sysfs, для проверки можно указать каталог с копией нужной части дерева.
+    """
+
+    def __init__(self, sensors, sysfs_root='/sys'):
+        discovered = discover_sensors(sysfs_root)
+        self.descriptors = {}
+
+        for key, sensor in sensors.items():
+            input_file = discovered.get(sensor)
+
+            if input_file is None:
+                print(f'Sensor {sensor[0]} {sensor[1]} not found')
+                continue
+
+            self.descriptors[key] = os.open(input_file, os.O_RDONLY)
+
+        self.keys = list(sensors)
+
+    def read(self):
+        """
+        Возвращает словарь ключ -> температура в градусах, для отсутствующего или неисправного датчика 0.
+        """
+        temperatures = dict.fromkeys(self.keys, 0)
+
+        for key, descriptor in self.descriptors.items():
+            value = read_value(descriptor)
+
+            if value is not None:
+                temperatures[key] = value
+
+        return temperatures
+
+    def close(self):
+        for descriptor in self.descriptors.values():
+            os.close(descriptor)
+
+        self.descriptors = {}
+
+
+class DrivetempReader:
+    """
+    Чтение температуры дисков из датчиков drivetemp.
+
+    :param sysfs_root: Корень sysfs.
+    """
+
+    def __init__(self, sysfs_root='/sys'):
+        self.drives = {}
+
+        for device, (model, input_file) in discover_drives(sysfs_root).items():
+            self.drives[device] = (model, os.open(input_file, os.O_RDONLY))
+
+    def read(self):
+        """
+        Возвращает словарь устройство -> (модель, температура в градусах или None).
+        """
+        return {device: (model, read_value(descriptor)) for device, (model, descriptor) in self.drives.items()}
+
+    def close(self):
+        for _, descriptor in self.drives.values():
+            os.close(descriptor)
+
+        self.drives = {}
@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+"""
+Общий код чтения медиатеки iTunes для скриптов работы со списками воспроизведения.
+"""
+import bisect
+import os
+import sqlite3
+import sys
+import urllib.parse
+from pathlib import Path
+from xml.etree import ElementTree
+
+TRACK_FIELD_TRACKS = 'Tracks'
+TRACK_FIELD_ID = 'Track ID'
+TRACK_FIELD_LOCATION = 'Location'
+TRACK_FIELD_NAME = 'Name'
+TRACK_FIELD_ARTIST = 'Artist'
+TRACK_FIELD_ALBUM = 'Album'
+TRACK_FIELD_YEAR = 'Year'
+TRACK_FIELD_NUMBER = 'Track Number'
+TRACK_FIELD_GENRE = 'Genre'
+TRACK_FIELD_DATE_ADDED = 'Date Added'
+TRACK_FIELD_TOTAL_TIME = 'Total Time'
+TRACK_FIELD_KIND = 'Kind'
+TRACK_FIELD_BIT_RATE = 'Bit Rate'
+TRACK_FIELD_SAMPLE_RATE = 'Sample Rate'
+
+PLAYLIST_FIELD_PLAYLISTS = 'Playlists'
+PLAYLIST_FIELD_NAME = 'Name'
+PLAYLIST_FIELD_ITEMS = 'Playlist Items'
+
+# Глубина вложенности элементов в XML файле медиатеки:
+# <plist> / <dict> медиатеки / <dict> треков или <array> списков / <dict> трека или списка.
+_SECTION_DEPTH = 2
+_RECORD_DEPTH = 3
+_PLAYLIST_ITEM_DEPTH = 5
+
+# Версия схемы кэша медиатеки, при изменении кэш перестраивается.
+CACHE_VERSION = 5
+# Число треков, вставляемых в кэш одним запросом.
+_CACHE_INSERT_BATCH = 1000
+
+# Соответствие колонок таблицы треков в кэше полям трека медиатеки.
+_CACHE_TRACK_COLUMNS = (
+    ('location', TRACK_FIELD_LOCATION),
+    ('name', TRACK_FIELD_NAME),
+    ('artist', TRACK_FIELD_ARTIST),
+    ('album', TRACK_FIELD_ALBUM),
+    ('year', TRACK_FIELD_YEAR),
+    ('number', TRACK_FIELD_NUMBER),
+    ('genre', TRACK_FIELD_GENRE),
+    ('date_added', TRACK_FIELD_DATE_ADDED),
+    ('total_time', TRACK_FIELD_TOTAL_TIME),
+    ('kind', TRACK_FIELD_KIND),
+    ('bit_rate', TRACK_FIELD_BIT_RATE),
+    ('sample_rate', TRACK_FIELD_SAMPLE_RATE))
+
+
+def get_itunes_library_path():
+    return Path.joinpath(Path.home(), 'Music', 'iTunes', 'iTunes Music Library.xml')
+
+
+def _get_plist_value(element):
+    """
+    Преобразует элемент plist в значение Python.
+    Даты остаются строками в формате ISO 8601, этого достаточно для сравнения и сортировки.
+    """
+    tag = element.tag
+
+    if tag == 'dict':
+        children = list(element)
+        return {key.text: _get_plist_value(value) for key, value in zip(children[::2], children[1::2])}
+
+    if tag == 'array':
+        return [_get_plist_value(child) for child in element]
+
+    if tag == 'integer':
+        return int(element.text)
+
+    if tag == 'real':
+        return float(element.text)
+
+    if tag == 'true':
+        return True
+
+    if tag == 'false':
+        return False
+
+    return element.text or ''
+
+
+def iter_library_records(library_path=None):
+    """
+    Последовательно читает XML файл медиатеки и возвращает записи по мере их разбора:
+    ('track', (идентификатор, словарь трека)) и ('playlist', словарь списка воспроизведения).
+    Разобранные элементы сразу удаляются из дерева, поэтому расход памяти не зависит от размера медиатеки.
+    Элементы списка воспроизведения возвращаются как список строковых идентификаторов треков.
+    """
+    library_path = library_path or get_itunes_library_path()
+
+    section = None
+    record_key = None
+    playlist_items = []
+    stack = []
+
+    for event, element in ElementTree.iterparse(str(library_path), events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            continue
+
+        depth = len(stack) - 1
+        stack.pop()
+        parent = stack[-1] if stack else None
+
+        if depth == _SECTION_DEPTH:
+            if element.tag == 'key':
+                section = element.text
+
+            parent.remove(element)
+            continue
+
+        if depth == _RECORD_DEPTH:
+            if element.tag == 'key':
+                record_key = element.text
+            elif section == TRACK_FIELD_TRACKS:
+                yield 'track', (record_key, _get_plist_value(element))
+            elif section == PLAYLIST_FIELD_PLAYLISTS:
+                playlist = _get_plist_value(element)
+
+                if PLAYLIST_FIELD_ITEMS in playlist:
+                    playlist[PLAYLIST_FIELD_ITEMS] = playlist_items
+
+                playlist_items = []
+                yield 'playlist', playlist
+
+            parent.remove(element)
+            continue
+
+        if depth == _PLAYLIST_ITEM_DEPTH and section == PLAYLIST_FIELD_PLAYLISTS and element.tag == 'dict':
+            # Элементы списка воспроизведения собираются сразу, чтобы не хранить их в дереве.
+            item = _get_plist_value(element)
+
+            if TRACK_FIELD_ID in item:
+                playlist_items.append(str(item[TRACK_FIELD_ID]))
+
+            parent.remove(element)
+
+
+class LibraryReader:
+    """
+    Чтение медиатеки из XML файла без кэша.
+    Каждый вызов tracks() и playlists() заново читает файл, поэтому методы можно вызывать в любом порядке,
+    например сначала списки воспроизведения, затем только входящие в них треки.
+    """
+
+    def __init__(self, library_path=None):
+        self.library_path = library_path
+
+    def records(self):
+        """
+        Возвращает все записи медиатеки за один проход по файлу, см. iter_library_records.
+        """
+        return iter_library_records(self.library_path)
+
+    def tracks(self, track_ids=None):
+        """
+        Возвращает пары (идентификатор, словарь трека).
+
+        :param track_ids: Идентификаторы возвращаемых треков, если не указаны, то возвращаются все треки.
+        """
+        tracks_read = False
+
+        for record_type, record in self.records():
+            if record_type == 'track':
+                tracks_read = True
+
+                if track_ids is None or record[0] in track_ids:
+                    yield record
+            elif tracks_read:
+                # Раздел треков закончился, остаток файла со списками воспроизведения не читается.
+                return
+
+    def playlists(self, names=None):
+        """
+        Возвращает списки воспроизведения.
+
+        :param names: Наименования возвращаемых списков, если не указаны, то возвращаются все списки.
+        """
+        for record_type, record in self.records():
+            if record_type == 'playlist' and (names is None or record.get(PLAYLIST_FIELD_NAME) in names):
+                yield record
+
+
+class LibraryCache:
+    """
+    Кэш разобранной медиатеки в файле SQLite рядом с XML файлом.
+    Кэш используется, пока не изменились время модификации и размер XML файла, иначе перестраивается.
+    Интерфейс чтения совпадает с LibraryReader.
+    """
+
+    def __init__(self, library_path=None, cache_path=None):
+        self.library_path = Path(library_path or get_itunes_library_path())
+        self.cache_path = Path(cache_path or self.library_path.with_name(self.library_path.name + '.cache.sqlite'))
+        self._connection = None
+
+    def open(self):
+        stat = self.library_path.stat()
+        signature = {'version': str(CACHE_VERSION), 'mtime_ns': str(stat.st_mtime_ns), 'size': str(stat.st_size)}
+
+        if self._read_signature() != signature:
+            print('Rebuild iTunes library cache', self.cache_path)
+            self._build(signature)
+
+        self._connection = sqlite3.connect(str(self.cache_path))
+        return self
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_signature(self):
+        if not self.cache_path.exists():
+            return None
+
+        try:
+            connection = sqlite3.connect(str(self.cache_path))
+
+            try:
+                return dict(connection.execute('select key, value from meta'))
+            finally:
+                connection.close()
+        except sqlite3.DatabaseError:
+            return None
+
+    def _build(self, signature):
+        # Кэш собирается во временном файле и подменяется целиком, чтобы параллельно
+        # запущенные скрипты не увидели недостроенный кэш.
+        temp_path = self.cache_path.with_name(f'{self.cache_path.name}.{os.getpid()}.tmp')
+
+        if temp_path.exists():
+            temp_path.unlink()
+
+        columns = ', '.join(column for column, _ in _CACHE_TRACK_COLUMNS)
+        placeholders = ', '.join('?' for _ in _CACHE_TRACK_COLUMNS)
+
+        connection = sqlite3.connect(str(temp_path))
+
+        try:
+            connection.execute('pragma journal_mode = off')
+            connection.execute('pragma synchronous = off')
+            connection.execute('create table meta (key text primary key, value text)')
+            connection.execute(f'create table tracks (track_id text primary key, {columns})')
+            connection.execute('create table playlists (playlist_id integer primary key, name text, has_items integer)')
+            connection.execute(
+                'create table playlist_items (playlist_id integer, position integer, track_id text, '
+                'primary key (playlist_id, position))')
+            connection.execute('create index playlists_name on playlists (name)')
+
+            # Кэш строится за один проход по XML файлу, треки вставляются пачками.
+            track_query = f'insert into tracks (track_id, {columns}) values (?, {placeholders})'
+            track_rows = []
+            playlist_id = 0
+
+            for record_type, record in LibraryReader(self.library_path).records():
+                if record_type == 'track':
+                    track_id, track_info = record
+                    track_rows.append((track_id, *(track_info.get(field) for _, field in _CACHE_TRACK_COLUMNS)))
+
+                    if len(track_rows) >= _CACHE_INSERT_BATCH:
+                        connection.executemany(track_query, track_rows)
+                        track_rows = []
+
+                    continue
+
+                items = record.get(PLAYLIST_FIELD_ITEMS)
+                connection.execute(
+                    'insert into playlists (playlist_id, name, has_items) values (?, ?, ?)',
+                    (playlist_id, record.get(PLAYLIST_FIELD_NAME, ''), items is not None))
+                connection.executemany(
+                    'insert into playlist_items (playlist_id, position, track_id) values (?, ?, ?)',
+                    ((playlist_id, position, track_id) for position, track_id in enumerate(items or [])))
+                playlist_id += 1
+
+            connection.executemany(track_query, track_rows)
+
+            connection.executemany('insert into meta (key, value) values (?, ?)', signature.items())
+            connection.commit()
+        finally:
+            connection.close()
+
+        os.replace(str(temp_path), str(self.cache_path))
+
+    def tracks(self, track_ids=None):
+        """
+        Возвращает пары (идентификатор, словарь трека), пустые поля в словарь не попадают.
+
+        :param track_ids: Идентификаторы возвращаемых треков, если не указаны, то возвращаются все треки.
+        """
+        columns = ', '.join(column for column, _ in _CACHE_TRACK_COLUMNS)
+
+        if track_ids is None:
+            rows = self._connection.execute(f'select track_id, {columns} from tracks')
+        else:
+            # Выборка по первичному ключу, стоимость зависит от числа запрошенных треков, а не от размера медиатеки.
+            self._connection.execute('create temp table if not exists wanted_tracks (track_id text primary key)')
+            self._connection.execute('delete from wanted_tracks')
+            self._connection.executemany(
+                'insert or ignore into wanted_tracks (track_id) values (?)',
+                ((track_id,) for track_id in track_ids))
+            rows = self._connection.execute(
+                f'select track_id, {columns} from tracks where track_id in (select track_id from wanted_tracks)')
+
+        for row in rows.fetchall():
+            yield row[0], {
+                field: value
+                for (_, field), value in zip(_CACHE_TRACK_COLUMNS, row[1:])
+                if value is not None}
+
+    def playlists(self, names=None):
+        """
+        Возвращает списки воспроизведения в порядке медиатеки.
+
+        :param names: Наименования возвращаемых списков, если не указаны, то возвращаются все списки.
+        """
+        if names is None:
+            playlists = self._connection.execute(
+                'select playlist_id, name, has_items from playlists order by playlist_id').fetchall()
+        else:
+            names = list(names)
+            placeholders = ', '.join('?' for _ in names)
+            playlists = self._connection.execute(
+                f'select playlist_id, name, has_items from playlists where name in ({placeholders}) '
+                f'order by playlist_id',
+                names).fetchall()
+
+        for playlist_id, name, has_items in playlists:
+            playlist = {PLAYLIST_FIELD_NAME: name}
+
+            if has_items:
+                playlist[PLAYLIST_FIELD_ITEMS] = [
+                    track_id for track_id, in self._connection.execute(
+                        'select track_id from playlist_items where playlist_id = ? order by position',
+                        (playlist_id,))]
+
+            yield playlist
+
+
+class Track:
+    """
+    Трек медиатеки.
+    Каталог, альбом и исполнитель интернируются, поэтому повторяющиеся строки хранятся в одном экземпляре.
+    """
+
+    __slots__ = (
+        'track_id', 'folder', 'file_name', 'name', 'artist', 'album', 'year', 'number', 'genre', 'date_added',
+        'total_time', 'kind', 'bit_rate', 'sample_rate')
+
+    def __init__(self, track_id, location, name='', artist='', album='', year=0, number=0, genre='', date_added='',
+                 total_time=0, kind='', bit_rate=0, sample_rate=0):
+        self.track_id = track_id
+        self.location = location
+        self.name = name
+        self.artist = sys.intern(artist)
+        self.album = sys.intern(album)
+        self.year = year
+        self.number = number
+        self.genre = sys.intern(genre)
+        self.date_added = date_added
+        # Длительность в миллисекундах.
+        self.total_time = total_time
+        self.kind = sys.intern(kind)
+        # Битрейт в кбит/с и частота дискретизации в Гц.
+        self.bit_rate = bit_rate
+        self.sample_rate = sample_rate
+
+    @property
+    def location(self):
+        return self.folder + self.file_name
+
+    @location.setter
+    def location(self, value):
+        split_position = max(value.rfind('/'), value.rfind('\\')) + 1
+        self.folder = sys.intern(value[:split_position])
+        self.file_name = value[split_position:]
+
+    def __repr__(self):
+        return f'Track({self.track_id!r}, {self.location!r})'
+
+
+def get_track(track_id, track_info):
+    """
+    Создает трек по словарю трека медиатеки.
+    Возвращает None, если трек не ссылается на локальный файл.
+    """
+    location = track_info.get(TRACK_FIELD_LOCATION)
+
+    if location is None or not location.startswith('file://'):
+        return None
+
+    return Track(
+        track_id,
+        urllib.parse.unquote(location[len('file://'):]),
+        name=track_info.get(TRACK_FIELD_NAME, ''),
+        artist=track_info.get(TRACK_FIELD_ARTIST, ''),
+        album=track_info.get(TRACK_FIELD_ALBUM, ''),
+        year=track_info.get(TRACK_FIELD_YEAR, 0),
+        number=track_info.get(TRACK_FIELD_NUMBER, 0),
+        genre=track_info.get(TRACK_FIELD_GENRE, ''),
+        date_added=track_info.get(TRACK_FIELD_DATE_ADDED, ''),
+        total_time=track_info.get(TRACK_FIELD_TOTAL_TIME, 0),
+        kind=track_info.get(TRACK_FIELD_KIND, ''),
+        bit_rate=track_info.get(TRACK_FIELD_BIT_RATE, 0),
+        sample_rate=track_info.get(TRACK_FIELD_SAMPLE_RATE, 0))
+
+
+def get_tracks_map(tracks):
+    """
+    Возвращает словарь треков по идентификатору, берется только то, что ссылается на локальный файл.
+
+    :param tracks: Пары (идентификатор, словарь трека) из LibraryReader или LibraryCache.
+    """
+    result = {}
+
+    for track_id, track_info in tracks:
+        track = get_track(track_id, track_info)
+
+        if track is not None:
+            result[track_id] = track
+
+    return result
+
+
+class TrackIndex:
+    """
+    Вторичные индексы по полям треков и выборка треков по условиям без полного перебора.
+
+    Условие запроса задается словарем {поле: значение}, все условия должны выполняться одновременно.
+    Значение поля может быть:
+        - скалярным значением, например "genre": "Rock";
+        - списком допустимых значений, например "artist": ["Queen", "Muse"];
+        - диапазоном {"from": ..., "to": ...}, любая граница может отсутствовать,
+          например "year": {"from": 1990, "to": 1999} или "date_added": {"from": "2020-01-01"}.
+    Границы дат могут быть неполными ("2020-05-01", "2020-05"), верхняя граница включает весь указанный период.
+    Значения приводятся к типу поля ("year": {"from": "1990"}), треки без значения поля (год 0, пустая дата)
+    в диапазоны не попадают.
+    """
+
+    # Поля запросов и их типы, значение типа по умолчанию означает, что у трека поле не заполнено.
+    FIELDS = {'year': int, 'album': str, 'artist': str, 'genre': str, 'date_added': str}
+    # Поля с датами в формате ISO 8601, например 2020-05-01T10:00:00Z.
+    DATE_FIELDS = ('date_added',)
+
+    def __init__(self, tracks):
+        self._tracks = list(tracks)
+        self._positions = {track: position for position, track in enumerate(self._tracks)}
+        self._indexes = {}
+        self._sorted_values = {}
+
+    def _get_index(self, field):
+        if field not in self.FIELDS:
+            raise ValueError(f'Unknown track field in query: {field}')
+
+        # Индексы строятся при первом обращении к полю.
+        index = self._indexes.get(field)
+
+        if index is None:
+            index = {}
+
+            for track in self._tracks:
+                index.setdefault(getattr(track, field), []).append(track)
+
+            self._indexes[field] = index
+            # Пустые значения не входят в диапазоны, иначе диапазон без нижней границы выбирал бы треки без года.
+            self._sorted_values[field] = sorted(value for value in index if value != self.FIELDS[field]())
+
+        return index
+
+    def _get_value(self, field, value):
+        # Значение из файла запросов приводится к типу поля, иначе сравнение с ключами индекса не работает.
+        field_type = self.FIELDS[field]
+        error = ValueError(f'Invalid value for track field {field}: {value!r}, expected {field_type.__name__}')
+
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise error
+
+        try:
+            return field_type(value)
+        except ValueError:
+            raise error from None
+
+    def _get_upper_bound(self, field, value):
+        # Все даты, начинающиеся с границы, сортируются не дальше границы с максимальным символом в конце.
+        value = self._get_value(field, value)
+
+        return value + '\uffff' if field in self.DATE_FIELDS else value
+
+    def _select_condition(self, field, condition):
+        index = self._get_index(field)
+
+        if isinstance(condition, dict):
+            sorted_values = self._sorted_values[field]
+            start = 0 if 'from' not in condition \
+                else bisect.bisect_left(sorted_values, self._get_value(field, condition['from']))
+            stop = len(sorted_values) if 'to' not in condition \
+                else bisect.bisect_right(sorted_values, self._get_upper_bound(field, condition['to']))
+            values = sorted_values[start:stop]
+        elif isinstance(condition, list):
+            values = [self._get_value(field, value) for value in condition]
+        else:
+            values = [self._get_value(field, condition)]
+
+        return {track for value in values for track in index.get(value, ())}
+
+    def select(self, query):
+        """
+        Возвращает треки удовлетворяющие запросу в порядке их добавления в индекс.
+        """
+        selections = sorted(
+            (self._select_condition(field, condition) for field, condition in query.items()),
+            key=len)
+
+        if not selections:
+            return list(self._tracks)
+
+        # Пересечение начинается с самой маленькой выборки.
+        result = selections[0]
+
+        for selection in selections[1:]:
+            result = result.intersection(selection)
+
+        return sorted(result, key=self._positions.__getitem__)
+
+
+def get_playlist_track_ids(playlists):
+    """
+    Возвращает множество идентификаторов треков, входящих в указанные списки воспроизведения.
+    """
+    return {track_id for playlist in playlists for track_id in playlist.get(PLAYLIST_FIELD_ITEMS, [])}
+
+
+def open_library(library_path=None):
+    """
+    Открывает медиатеку iTunes через кэш, перестраивая его при изменении XML файла.
+    """
+    return LibraryCache(library_path).open()
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Запуск внешних процессов (ffmpeg) через asyncio с ограничением числа одновременно работающих процессов.
+Число процессов может подстраиваться под загрузку системы по данным /proc.
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import os
+import time
+
+# Сколько последних строк stderr сохраняется в результате для диагностики ошибок.
+STDERR_TAIL_LINES = 20
+
+# Фазы задач для раздельного ограничения числа задач: чтение исходных файлов (декодирование, измерение)
+# и запись файлов результата (перекодирование, копирование).
+PHASE_INPUT = 'input'
+PHASE_OUTPUT = 'output'
+
+# Интервал пересчета числа процессов в адаптивном режиме в секундах.
+ADAPT_INTERVAL = 10.0
+# Доля времени ожидания ввода-вывода, выше которой число процессов уменьшается.
+IOWAIT_LIMIT = 0.2
+# Средняя загрузка на ядро, выше которой число процессов уменьшается.
+LOAD_LIMIT = 1.5
+# Относительное падение пропускной способности (объема завершенной работы в секунду),
+# при котором направление изменения числа процессов меняется.
+THROUGHPUT_DROP = 0.1
+
+
+class ProcessResult:
+    """
+    Результат выполнения процесса.
+    """
+
+    def __init__(self, argv, returncode, stderr_tail, elapsed, timed_out=False, stdout=''):
+        self.argv = argv
+        self.returncode = returncode
+        self.stderr_tail = stderr_tail
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.stdout = stdout
+        # Фаза и время ожидания места для запуска, заполняются JobRunner.
+        self.phase = None
+        self.queue_wait = 0.0
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def get_error(self):
+        if self.timed_out:
+            return f'timeout after {self.elapsed:.0f} s'
+
+        return f'exit code {self.returncode}: ' + ' | '.join(self.stderr_tail[-3:])
+
+
+async def _read_stderr(stream, stderr_tail, line_handler):
+    # stderr читается построчно по мере вывода, в памяти хранится только хвост.
+    while True:
+        line = await stream.readline()
+
+        if not line:
+            return
+
+        text = line.decode('utf-8', errors='replace').rstrip()
+        stderr_tail.append(text)
+
+        if line_handler is not None:
+            line_handler(text)
+
+
+async def _communicate(process, stderr_tail, line_handler):
+    if process.stdout is None:
+        await _read_stderr(process.stderr, stderr_tail, line_handler)
+        await process.wait()
+        return ''
+
+    stdout, _ = await asyncio.gather(process.stdout.read(), _read_stderr(process.stderr, stderr_tail, line_handler))
+    await process.wait()
+
+    return stdout.decode('utf-8', errors='replace')
+
+
+async def run_process(argv, timeout=None, line_handler=None, capture_stdout=False):
+    """
+    Запускает процесс без оболочки и возвращает ProcessResult.
+
+    :param argv: Команда и аргументы.
+    :param timeout: Максимальное время работы процесса в секундах, по истечении процесс завершается.
+    :param line_handler: Функция, вызываемая для каждой строки stderr.
+    :param capture_stdout: Сохранить stdout процесса в результате, используется для коротких ответов ffprobe.
+    """
+    started = time.monotonic()
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        return ProcessResult(argv, None, [str(e)], time.monotonic() - started)
+
+    timed_out = False
+    stdout = ''
+
+    try:
+        stdout = await asyncio.wait_for(_communicate(process, stderr_tail, line_handler), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        process.kill()
+        await process.wait()
+
+    return ProcessResult(
+        argv, process.returncode, list(stderr_tail), time.monotonic() - started, timed_out, stdout)
+
+
+class PriorityLimiter:
+    """
+    Ограничение числа одновременно выполняемых задач, ожидающие задачи запускаются в порядке убывания приоритета.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority=0):
+        if self._active < self.limit and not self._waiters:
+            self._active += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        # При равном приоритете задачи запускаются в порядке поступления.
+        heapq.heappush(self._waiters, (-priority, next(self._sequence), waiter))
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake()
+
+    def release(self):
+        self._active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._active < self.limit:
+            _, _, waiter = heapq.heappop(self._waiters)
+
+            if not waiter.done():
+                self._active += 1
+                waiter.set_result(None)
+
+
+class SystemMonitor:
+    """
+    Загрузка системы по данным /proc: средняя загрузка и доля ожидания ввода-вывода.
+    """
+
+    def __init__(self, proc_root='/proc'):
+        self.proc_root = proc_root
+        self._cpu_times = self._read_cpu_times()
+
+    @property
+    def available(self):
+        return self._cpu_times is not None
+
+    def _read_cpu_times(self):
+        try:
+            with open(os.path.join(self.proc_root, 'stat'), 'rt') as fp:
+                return [int(value) for value in fp.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+
+    def get_iowait(self):
+        """
+        Доля времени ожидания ввода-вывода с предыдущего вызова.
+        """
+        cpu_times = self._read_cpu_times()
+        previous, self._cpu_times = self._cpu_times, cpu_times
+
+        if cpu_times is None or previous is None:
+            return 0.0
+
+        deltas = [current - last for current, last in zip(cpu_times, previous)]
+        total = sum(deltas)
+
+        # Пятое поле строки cpu - время ожидания ввода-вывода.
+        return deltas[4] / total if total > 0 and len(deltas) > 4 else 0.0
+
+    def get_load_average(self):
+        try:
+            with open(os.path.join(self.proc_root, 'loadavg'), 'rt') as fp:
+                return float(fp.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return 0.0
+
+
+class ConcurrencyController:
+    """
+    Подбирает число одновременно запущенных процессов по объему завершенной работы в секунду,
+    доле ожидания ввода-вывода и средней загрузке системы.
+    Работа засчитывается при завершении процесса, поэтому короткие процессы учитываются полностью,
+    а не только попавшие на момент замера.
+    Число процессов меняется на единицу за шаг: при перегрузке системы уменьшается, иначе изменяется
+    в том же направлении, пока пропускная способность не начнет падать.
+    """
+
+    def __init__(self, limiter: PriorityLimiter, max_limit, monitor: SystemMonitor):
+        self.limiter = limiter
+        self.max_limit = max_limit
+        self.monitor = monitor
+        self.cpu_count = os.cpu_count() or 1
+        self._direction = 1
+        self._last_throughput = None
+        self._work = 0.0
+        self.min_seen = limiter.limit
+        self.max_seen = limiter.limit
+
+    def add_work(self, work):
+        """
+        Засчитывает работу завершившегося процесса, например длительность обработанного трека в секундах.
+        """
+        self._work += work
+
+    def step(self, elapsed):
+        """
+        Шаг подстройки, возвращает объем завершенной за интервал работы в секунду.
+        """
+        throughput = self._work / elapsed if elapsed > 0 else 0.0
+        completed = self._work > 0
+        self._work = 0.0
+
+        iowait = self.monitor.get_iowait()
+        load_average = self.monitor.get_load_average()
+        overloaded = iowait > IOWAIT_LIMIT or load_average > LOAD_LIMIT * self.cpu_count
+
+        if overloaded:
+            self._direction = -1
+        elif not completed:
+            # За интервал не завершился ни один процесс (длинные треки), сравнивать не с чем.
+            return throughput
+        elif self._last_throughput is not None and throughput < self._last_throughput * (1 - THROUGHPUT_DROP):
+            self._direction = -self._direction
+        elif self._direction > 0 and not self.limiter.waiting:
+            # Все задачи уже запущены, увеличивать число процессов бессмысленно.
+            self._last_throughput = throughput
+            return throughput
+
+        self._last_throughput = throughput
+        limit = min(max(self.limiter.limit + self._direction, 1), self.max_limit)
+
+        if limit != self.limiter.limit:
+            self.limiter.set_limit(limit)
+            self.min_seen = min(self.min_seen, limit)
+            self.max_seen = max(self.max_seen, limit)
+
+        return throughput
+
+
+class JobRunner:
+    """
+    Ограничивает число одновременно запущенных процессов и собирает статистику загрузки.
+
+    :param concurrency: Максимальное число одновременно запущенных процессов.
+    :param adaptive: Подстраивать число процессов под загрузку системы, concurrency при этом - верхняя граница.
+    :param phase_limits: Словарь ограничений числа процессов по фазам PHASE_INPUT и PHASE_OUTPUT.
+    """
+
+    def __init__(self, concurrency, timeout=None, adaptive=False, phase_limits=None, monitor=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.monitor = monitor or SystemMonitor()
+        self.adaptive = adaptive and self.monitor.available
+        # В адаптивном режиме работа начинается с половины максимального числа процессов.
+        self._limiter = PriorityLimiter(max(concurrency // 2, 1) if self.adaptive else concurrency)
+        self._phase_limiters = {
+            phase: PriorityLimiter(limit) for phase, limit in (phase_limits or {}).items() if limit}
+        self.controller = ConcurrencyController(self._limiter, concurrency, self.monitor) if self.adaptive else None
+        self._controller_task = None
+        self.started = time.monotonic()
+        # Суммарное время работы процессов и ожидания места для запуска.
+        self.busy_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+
+    async def _adapt(self):
+        while True:
+            await asyncio.sleep(ADAPT_INTERVAL)
+            self.controller.step(ADAPT_INTERVAL)
+
+    async def _acquire(self, priority, phase):
+        if self.adaptive and self._controller_task is None:
+            self._controller_task = asyncio.get_running_loop().create_task(self._adapt())
+
+        # Сначала занимается место фазы, затем общее, чтобы ожидающая фазы задача не занимала общее место.
+        phase_limiter = self._phase_limiters.get(phase)
+
+        if phase_limiter is not None:
+            await phase_limiter.acquire(priority)
+
+        try:
+            await self._limiter.acquire(priority)
+        except BaseException:
+            if phase_limiter is not None:
+                phase_limiter.release()
+            raise
+
+        return phase_limiter
+
+    def _release(self, phase_limiter):
+        self._limiter.release()
+
+        if phase_limiter is not None:
+            phase_limiter.release()
+
+    async def run(self, argv, line_handler=None, priority=0, capture_stdout=False, phase=None, work=0.0):
+        """
+        Запускает процесс, когда освободится место; из ожидающих первым запускается процесс с большим приоритетом.
+
+        :param work: Объем работы процесса для подстройки числа процессов, например длительность трека в секундах.
+        """
+        queued = time.monotonic()
+        phase_limiter = await self._acquire(priority, phase)
+        queue_wait = time.monotonic() - queued
+
+        try:
+            result = await run_process(argv, self.timeout, line_handler, capture_stdout)
+        finally:
+            self._release(phase_limiter)
+
+        if self.controller is not None and result.ok:
+            self.controller.add_work(work)
+
+        self.busy_seconds += result.elapsed
+        self.queue_wait_seconds += queue_wait
+        result.phase = phase
+        result.queue_wait = queue_wait
+
+        return result
+
+    async def call(self, function, *args, priority=0, phase=None):
+        """
+        Выполняет блокирующую функцию в потоке с теми же ограничениями, что и процессы, например копирование файла.
+        """
+        phase_limiter = await self._acquire(priority, phase)
+        started = time.monotonic()
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+        finally:
+            self.busy_seconds += time.monotonic() - started
+            self._release(phase_limiter)
+
+    def close(self):
+        if self._controller_task is not None:
+            self._controller_task.cancel()
+            self._controller_task = None
+
+    def get_utilization(self):
+        """
+        Возвращает (время работы, загрузку слотов процессов от 0 до 1).
+        """
+        wall_seconds = time.monotonic() - self.started
+
+        if wall_seconds <= 0:
+            return wall_seconds, 0.0
+
+        return wall_seconds, self.busy_seconds / (wall_seconds * self.concurrency)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Общий код скриптов выгрузки музыки из списков воспроизведения iTunes: выбор треков профилей выгрузки,
+имена файлов результата и перекодирование всех профилей за один запуск.
+"""
+from pathlib import Path
+
+import device_sync
+import itunes_library
+import transcode
+
+remove_punctuation_map = dict((ord(char), None) for char in '\'\\/*?:"<>|')
+
+
+class ExportProfile:
+    """
+    Профиль выгрузки: списки воспроизведения, каталог результата и параметры перекодирования.
+
+    :param playlists: Наименования списков воспроизведения из которых собираются треки.
+    :param out_folder: Наименование каталога в ~/Downloads в который копируются файлы или абсолютный путь каталога.
+    :param device_folder: Каталог на устройстве (SD карта, USB флешка), который синхронизируется с каталогом
+    результата после перекодирования, None - без синхронизации.
+    :param device_writers: Число потоков записи на устройство.
+    """
+
+    def __init__(self, playlists, out_folder, settings: transcode.TranscodeSettings, device_folder=None,
+                 device_writers=1):
+        self.playlists = playlists
+        self.out_folder = out_folder
+        self.settings = settings
+        self.device_folder = device_folder
+        self.device_writers = device_writers
+
+    def get_out_folder(self):
+        return Path.joinpath(Path.home(), 'Downloads', self.out_folder)
+
+
+def get_tracks_map(tracks):
+    print('Process iTunes library export file')
+
+    return itunes_library.get_tracks_map(tracks)
+
+
+def get_profile_tracks(playlists, tracks_map, profile: ExportProfile):
+    tracks = []
+    track_ids = set()
+    locations = set()
+    duplicates = 0
+
+    for playlist in playlists:
+        playlist_name = playlist['Name']
+
+        if playlist_name not in profile.playlists:
+            continue
+
+        if itunes_library.PLAYLIST_FIELD_ITEMS not in playlist:
+            # Пропускаем пустые списки воспроизведения.
+            continue
+
+        for track_id in playlist[itunes_library.PLAYLIST_FIELD_ITEMS]:
+            track = tracks_map[track_id]
+
+            # Трек из нескольких списков воспроизведения (или один файл под разными идентификаторами)
+            # обрабатывается один раз.
+            if track_id in track_ids or track.location in locations:
+                duplicates += 1
+                continue
+
+            track_ids.add(track_id)
+            locations.add(track.location)
+            tracks.append(track)
+
+    print(f'{profile.out_folder} tracks: {len(tracks)}, duplicates skipped: {duplicates}')
+
+    return tracks
+
+
+def get_destination_file(track, out_folder, settings: transcode.TranscodeSettings):
+    artist = track.artist.translate(remove_punctuation_map)
+    name = track.name.translate(remove_punctuation_map)
+
+    return Path.joinpath(
+        out_folder,
+        f'{artist} - {name}{settings.get_destination_suffix(Path(track.location))}')
+
+
+def get_destination_names(tracks, out_folder, settings: transcode.TranscodeSettings):
+    """
+    Возвращает имена файлов результата для треков.
+    Если у разных треков совпадает имя файла, то к имени добавляется номер, номера назначаются
+    в порядке идентификаторов треков, поэтому не зависят от порядка списков воспроизведения.
+    """
+    tracks_by_name = {}
+
+    for track in tracks:
+        tracks_by_name.setdefault(get_destination_file(track, out_folder, settings).name, []).append(track)
+
+    result = {}
+    collisions = 0
+
+    for destination_name, name_tracks in tracks_by_name.items():
+        name_tracks.sort(key=lambda t: int(t.track_id))
+        result[name_tracks[0]] = destination_name
+
+        destination_file = Path(destination_name)
+
+        for number, track in enumerate(name_tracks[1:], start=2):
+            result[track] = f'{destination_file.stem} ({number}){destination_file.suffix}'
+            collisions += 1
+
+    if collisions:
+        print(f'Renamed tracks with the same file name: {collisions}')
+
+    return result
+
+
+def get_output_profile(profile: ExportProfile, tracks):
+    out_folder = profile.get_out_folder()
+    destination_names = get_destination_names(tracks, out_folder, profile.settings)
+    source_tracks = [
+        transcode.SourceTrack(
+            Path(track.location),
+            destination_names[track],
+            duration=track.total_time / 1000,
+            kind=track.kind,
+            bit_rate=track.bit_rate,
+            sample_rate=track.sample_rate,
+            album=track.album)
+        for track in tracks]
+
+    return transcode.OutputProfile(out_folder, profile.settings, source_tracks)
+
+
+def export_profiles(profiles, library_path=None, report_folder=None):
+    """
+    Выгружает треки профилей, трек нужный нескольким профилям декодируется один раз.
+
+    :param profiles: Список ExportProfile с разными каталогами результата.
+    :param library_path: Файл медиатеки iTunes, по умолчанию медиатека текущего пользователя.
+    :param report_folder: Каталог отчета о запуске перекодирования.
+    """
+    library = itunes_library.open_library(library_path)
+    # Сначала читаются нужные списки воспроизведения, затем только входящие в них треки.
+    playlist_names = sorted({playlist_name for profile in profiles for playlist_name in profile.playlists})
+    playlists = list(library.playlists(playlist_names))
+    tracks_map = get_tracks_map(library.tracks(itunes_library.get_playlist_track_ids(playlists)))
+
+    output_profiles = [
+        get_output_profile(profile, get_profile_tracks(playlists, tracks_map, profile)) for profile in profiles]
+
+    results = transcode.transcode_profiles(output_profiles, report_folder)
+
+    for profile in profiles:
+        if profile.device_folder is None:
+            continue
+
+        if not device_sync.is_device_mounted(Path(profile.device_folder), profile.get_out_folder()):
+            print(f'Device {profile.device_folder} is not mounted, sync skipped')
+            continue
+
+        device_sync.sync_folder(profile.get_out_folder(), Path(profile.device_folder), profile.device_writers)
+
+    return results
@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
 # coding: utf8
-import re
-import subprocess
+import signal
+import sys
+import time
 import psycopg2
 import psycopg2.extras
 import datetime
 import ptvsd
 
+import hddtemp_client
+import hwmon_sensors
+
 
 # ptvsd.enable_attach(address=('192.168.1.14', 3000), redirect_output=True)
 # ptvsd.wait_for_attach()
 
+# Интервал опроса датчиков в секундах в режиме службы (--daemon).
+SAMPLE_INTERVAL = 60
+# Замеры записываются в БД пачкой по BATCH_SIZE замеров, но не реже чем раз в BATCH_SECONDS секунд.
+BATCH_SIZE = 10
+BATCH_SECONDS = 300
+# Пауза перед повторным подключением к недоступной БД в секундах.
+RECONNECT_DELAY = 30
+# Предельное число незаписанных замеров, пока БД недоступна, старые замеры отбрасываются.
+MAX_PENDING = 10000
+
+# Датчики hwmon: ключ замера -> (чип, метка как в выводе sensors).
+HWMON_SENSORS = {
+    'core0': ('coretemp', 'Core 0'),
+    'core1': ('coretemp', 'Core 1'),
+    'cpu': ('coretemp', 'Package id 0'),
+    'atz1': ('acpitz', 'temp1'),
+    'atz2': ('acpitz', 'temp2'),
+    'mb1': ('it8728', 'temp1'),
+    'mb2': ('it8728', 'temp3')}
+
+# Диски: ключ замера -> устройство в ответе hddtemp.
+DISKS = {
+    'sda': '/dev/sda',
+    'sdb': '/dev/sdb',
+    'sdc': '/dev/sdc'}
+
+INSERT_QUERY = "insert into temperatures.temperatures " \
+               "(Core0, Core1, CPU, ATZ1, ATZ2, MB1, MB2, SDA, SDB, SDC, TimeStamp) " \
+               "values (%(core0)s, %(core1)s, %(cpu)s, %(atz1)s, %(atz2)s, %(mb1)s, %(mb2)s, " \
+               "%(sda)s, %(sdb)s, %(sdc)s, %(timestamp)s)"
+
+
 class Connection:
     def __init__(self, host, database, user, password):
         self.host = host
@@ -19,105 +55,151 @@ class Connection:
         self.password = password
 
 
-def exec_shell(shell_command):
-    cmd = subprocess.Popen(shell_command, shell=True, stdout=subprocess.PIPE)
-    out, err = cmd.communicate()
-
-    if not (err is None):
-        return err
+def get_temperatures(hwmon_reader: hwmon_sensors.HwmonReader, disk_client: hddtemp_client.HddtempClient):
+    temperatures = {key: round(value) for key, value in hwmon_reader.read().items()}
+    disks = disk_client.read()
 
-    return out.decode(encoding="utf8")
+    for key, device in DISKS.items():
+        # Для отсутствующего или спящего диска записывается 0, как для отсутствующих датчиков hwmon.
+        _, temperature = disks.get(device, (None, None))
+        temperatures[key] = temperature if temperature is not None else 0
 
+    temperatures['timestamp'] = datetime.datetime.now()
 
-def get_temperature_value(temp_in_string):
-    regex = re.compile(r'^.*:+\s+(\++\d+\.\d+)', re.DOTALL)
-    temp = regex.findall(temp_in_string)
+    return temperatures
 
-    if not temp:
-        return 0
 
-    return round(float(temp[0]))
+class TemperatureWriter:
+    """
+    Запись замеров в БД пачками через одно постоянное подключение.
+    При ошибке подключение закрывается и пересоздается при следующей записи, замеры сохраняются до нее.
+    """
 
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.postgresql_connection = None
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.retry_at = 0.0
 
-def get_temperatures():
-    core0 = 0
-    core1 = 0
-    cpu = 0
-    mb1 = 0
-    mb2 = 0
-    atz1 = 0
-    atz2 = 0
+    def connect(self):
+        if self.postgresql_connection is None or self.postgresql_connection.closed:
+            self.postgresql_connection = psycopg2.connect(
+                host=self.connection.host,
+                database=self.connection.database,
+                user=self.connection.user,
+                password=self.connection.password)
 
-    out = exec_shell('sensors coretemp-isa-0000').split("\n")
+        return self.postgresql_connection
 
-    for line in out:
-        if 'Core 0:' in line:
-            core0 = get_temperature_value(line)
+    def close(self):
+        if self.postgresql_connection is not None:
+            self.postgresql_connection.close()
+            self.postgresql_connection = None
 
-        if 'Core 1:' in line:
-            core1 = get_temperature_value(line)
+    def add(self, temperatures):
+        self.pending.append(temperatures)
 
-        if 'Package id 0:' in line:
-            cpu = get_temperature_value(line)
+        if len(self.pending) > MAX_PENDING:
+            del self.pending[:len(self.pending) - MAX_PENDING]
 
-    out = exec_shell('sensors acpitz-virtual-0').split("\n")
+    def is_flush_due(self):
+        return len(self.pending) >= BATCH_SIZE or time.monotonic() - self.last_flush >= BATCH_SECONDS
 
-    for line in out:
-        if 'temp1:' in line:
-            atz1 = get_temperature_value(line)
+    def flush(self):
+        """
+        Записывает накопленные замеры одной транзакцией, возвращает False если БД недоступна.
+        """
+        if not self.pending:
+            return True
 
-        if 'temp2:' in line:
-            atz2 = get_temperature_value(line)
+        if time.monotonic() < self.retry_at:
+            return False
 
-    out = exec_shell('sensors it8728-isa-0a30').split("\n")
+        try:
+            postgresql_connection = self.connect()
 
-    for line in out:
-        if 'temp1:' in line:
-            mb1 = get_temperature_value(line)
+            with postgresql_connection.cursor() as postgresql_cursor:
+                psycopg2.extras.execute_batch(postgresql_cursor, INSERT_QUERY, self.pending, page_size=100)
 
-        if 'temp3:' in line:
-            mb2 = get_temperature_value(line)
+            postgresql_connection.commit()
+        except psycopg2.Error as e:
+            print(f'Insert temperatures failed, pending samples: {len(self.pending)}: {e}', file=sys.stderr)
+            self.close()
+            self.retry_at = time.monotonic() + RECONNECT_DELAY
 
-    out = exec_shell('nc localhost 7634')
+            return False
 
-    temps = out.split('|')
-    sda = float(temps[3])
-    sdb = float(temps[8])
-    sdc = float(temps[13])
+        self.pending.clear()
+        self.last_flush = time.monotonic()
 
-    return {
-        'core0': core0,
-        'core1': core1,
-        'cpu': cpu,
-        'atz1': atz1,
-        'atz2': atz2,
-        'mb1': mb1,
-        'mb2': mb2,
-        'sda': sda,
-        'sdb': sdb,
-        'sdc': sdc,
-        'timestamp': datetime.datetime.now()}
+        return True
 
 
 def do_insert_temperatures(connection: Connection):
-    temperatures = get_temperatures()
-    postgresql_connection = psycopg2.connect(
-        host=connection.host,
-        database=connection.database,
-        user=connection.user,
-        password=connection.password)
-    postgresql_cursor = postgresql_connection.cursor()
-
-    query = "insert into temperatures.temperatures " \
-            "(Core0, Core1, CPU, ATZ1, ATZ2, MB1, MB2, SDA, SDB, SDC, TimeStamp) " \
-            "values (%(core0)s, %(core1)s, %(cpu)s, %(atz1)s, %(atz2)s, %(mb1)s, %(mb2)s, %(sda)s, %(sdb)s, %(sdc)s, %(timestamp)s)"
-
-    postgresql_cursor.execute(query, temperatures)
-
-    postgresql_connection.commit()
-    postgresql_connection.close()
+    hwmon_reader = hwmon_sensors.HwmonReader(HWMON_SENSORS)
+    disk_client = hddtemp_client.HddtempClient()
+    writer = TemperatureWriter(connection)
+
+    try:
+        writer.add(get_temperatures(hwmon_reader, disk_client))
+    finally:
+        hwmon_reader.close()
+        disk_client.close()
+
+    try:
+        if not writer.flush():
+            sys.exit(1)
+    finally:
+        writer.close()
+
+
+def run_daemon(connection: Connection, interval):
+    """
+    Опрашивает датчики с заданным интервалом в одном процессе и пишет замеры в БД пачками.
+    По SIGTERM или Ctrl+C накопленные замеры записываются перед выходом.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Датчики находятся один раз, далее каждый замер только читает открытые файлы.
+    hwmon_reader = hwmon_sensors.HwmonReader(HWMON_SENSORS)
+    disk_client = hddtemp_client.HddtempClient()
+    writer = TemperatureWriter(connection)
+    next_sample = time.monotonic()
+
+    try:
+        while True:
+            try:
+                writer.add(get_temperatures(hwmon_reader, disk_client))
+            except OSError as e:
+                print(f'Read temperatures failed: {e}', file=sys.stderr)
+
+            if writer.is_flush_due():
+                writer.flush()
+
+            # Замеры идут по сетке интервала, после долгой записи пропущенные замеры не догоняются.
+            next_sample += interval
+            now = time.monotonic()
+
+            if next_sample < now:
+                next_sample = now + interval
+
+            time.sleep(next_sample - now)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Перед выходом запись выполняется без ожидания паузы повторного подключения.
+        writer.retry_at = 0.0
+        writer.flush()
+        writer.close()
+        hwmon_reader.close()
+        disk_client.close()
 
 
 if __name__ == "__main__":
     g_connection = Connection('192.168.1.14', 'temperatures', 'temperatures', 'temperatures')
-    do_insert_temperatures(g_connection)
+
+    # Без параметров записывается один замер (запуск из cron), с --daemon [интервал] скрипт работает как служба.
+    if len(sys.argv) > 1 and sys.argv[1] == '--daemon':
+        run_daemon(g_connection, float(sys.argv[2]) if len(sys.argv) > 2 else SAMPLE_INTERVAL)
+    else:
+        do_insert_temperatures(g_connection)
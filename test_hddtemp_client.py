@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка клиента hddtemp на локальном тестовом сервере hddtemp и тестовом дереве sysfs.
+"""
+import socket
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+import hddtemp_client
+
+
+class FakeHddtempServer:
+    """
+    Сервер, который как hddtemp отдает ответ каждому подключению и закрывает соединение.
+    """
+
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.connections = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen()
+        # accept() ждет с таймаутом, чтобы поток сервера можно было остановить.
+        self._socket.settimeout(0.1)
+        self.port = self._socket.getsockname()[1]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+
+            with connection:
+                self.connections += 1
+                connection.sendall(self.payload)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._socket.close()
+
+
+def get_closed_port():
+    # Порт, на котором никто не слушает: подключение к нему отклоняется.
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def create_drivetemp(sysfs_root: Path, hwmon_name, block_name, model, millidegrees):
+    device_folder = Path.joinpath(sysfs_root, 'class', 'hwmon', hwmon_name)
+    Path.joinpath(device_folder, 'device', 'block', block_name).mkdir(parents=True)
+    Path.joinpath(device_folder, 'name').write_text('drivetemp\n')
+    Path.joinpath(device_folder, 'device', 'model').write_text(f'{model}\n')
+    Path.joinpath(device_folder, 'temp1_input').write_text(f'{millidegrees}\n')
+
+
+class HddtempClientTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.sysfs_root = Path(self.temp_folder.name)
+
+    def tearDown(self):
+        self.temp_folder.cleanup()
+
+    def read(self, payload):
+        server = FakeHddtempServer(payload)
+
+        try:
+            client = hddtemp_client.HddtempClient('127.0.0.1', server.port, sysfs_root=self.sysfs_root)
+
+            try:
+                return client.read()
+            finally:
+                client.close()
+        finally:
+            server.close()
+
+    def test_device_keyed_records(self):
+        disks = self.read(b'|/dev/sda|Model A|40|C||/dev/sdb|Model B|104|F|')
+
+        self.assertEqual(['/dev/sda', '/dev/sdb'], sorted(disks))
+        self.assertEqual(('Model A', 40.0), disks['/dev/sda'])
+
+    def test_fahrenheit_converted_to_celsius(self):
+        model, temperature = self.read(b'|/dev/sda|Model A|40|C||/dev/sdb|Model B|104|F|')['/dev/sdb']
+
+        self.assertEqual('Model B', model)
+        self.assertAlmostEqual(40.0, temperature)
+
+    def test_unknown_temperature_and_malformed_record(self):
+        disks = self.read(b'|/dev/sda|Model A|SLP|*||/dev/sdb|Model B|UNK|*||/dev/sdc|broken||/dev/sdd|Model D|35|C|')
+
+        self.assertEqual(('Model A', None), disks['/dev/sda'])
+        self.assertEqual(('Model B', None), disks['/dev/sdb'])
+        self.assertNotIn('/dev/sdc', disks)
+        self.assertEqual(('Model D', 35.0), disks['/dev/sdd'])
+
+    def test_empty_response(self):
+        self.assertEqual({}, self.read(b''))
+
+    def test_new_connection_per_read(self):
+        server = FakeHddtempServer(b'|/dev/sda|Model A|40|C|')
+
+        try:
+            client = hddtemp_client.HddtempClient('127.0.0.1', server.port, drivetemp_fallback=False)
+            client.read()
+            client.read()
+        finally:
+            server.close()
+
+        self.assertEqual(2, server.connections)
+
+    def test_drivetemp_fallback_when_connection_refused(self):
+        create_drivetemp(self.sysfs_root, 'hwmon3', 'sdb', 'Model B', 41000)
+        client = hddtemp_client.HddtempClient('127.0.0.1', get_closed_port(), timeout=0.5, sysfs_root=self.sysfs_root)
+
+        try:
+            self.assertEqual({'/dev/sdb': ('Model B', 41.0)}, client.read())
+        finally:
+            client.close()
+
+    def test_connection_refused_without_fallback(self):
+        client = hddtemp_client.HddtempClient('127.0.0.1', get_closed_port(), timeout=0.5, drivetemp_fallback=False)
+
+        with self.assertRaises(OSError):
+            client.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
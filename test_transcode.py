@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка перекодирования с тестовым ffmpeg, который записывает аргументы запуска и файл результата.
+Громкость треков заранее записывается в кэш измерений, поэтому ffmpeg запускается только для перекодирования.
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import transcode
+
+FAKE_FFMPEG = f'''#!{sys.executable}
+import json
+import os
+import sys
+
+with open(os.environ['FAKE_FFMPEG_LOG'], 'at') as fp:
+    fp.write(json.dumps(sys.argv[1:]) + '\\n')
+
+with open(sys.argv[-1], 'wb') as fp:
+    fp.write(b'encoded')
+'''
+
+# Измеренная громкость треков альбома, у треков разная громкость и усиление трека отличается от усиления альбома.
+ALBUM_LOUDNESS = ('-14.00', '-17.00', '-20.00', '-23.00')
+
+
+@unittest.skipIf(os.name == 'nt', 'fake ffmpeg is a script with a shebang line')
+class AlbumGainTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_folder.name)
+
+        bin_folder = Path.joinpath(self.root, 'bin')
+        bin_folder.mkdir()
+        ffmpeg = Path.joinpath(bin_folder, 'ffmpeg')
+        ffmpeg.write_text(FAKE_FFMPEG)
+        ffmpeg.chmod(0o755)
+
+        self.ffmpeg_log = Path.joinpath(self.root, 'ffmpeg.log')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = bin_folder.as_posix() + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKE_FFMPEG_LOG'] = self.ffmpeg_log.as_posix()
+
+        self.cache_path = Path.joinpath(self.root, 'loudnorm-cache.sqlite')
+        self.out_folder = Path.joinpath(self.root, 'out')
+        self.settings = transcode.TranscodeSettings(
+            transcode.LoudnessTarget(), engine=transcode.ENGINE_TWO_PASS, gain_mode=transcode.GAIN_ALBUM,
+            concurrency=2, adaptive_concurrency=False, cache_path=self.cache_path)
+
+        source_folder = Path.joinpath(self.root, 'source', 'Album')
+        source_folder.mkdir(parents=True)
+        self.source_tracks = []
+        cache = transcode.LoudnessCache(self.cache_path)
+
+        try:
+            for number, input_i in enumerate(ALBUM_LOUDNESS, 1):
+                source_file = Path.joinpath(source_folder, f'{number:02d}.flac')
+                source_file.write_bytes(b'source')
+                cache.put(source_file, self.settings.target,
+                          transcode.LoudnessMeasurement(input_i, '-3.00', '5.00', '-30.00'))
+                self.source_tracks.append(
+                    transcode.SourceTrack(source_file, f'{number:02d}.mp3', duration=200.0, album='Album'))
+        finally:
+            cache.close()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.temp_folder.cleanup()
+
+    def transcode(self):
+        """
+        Запускает перекодирование, возвращает словарь файл результата -> фильтр громкости.
+        """
+        if self.ffmpeg_log.exists():
+            self.ffmpeg_log.unlink()
+
+        profile = transcode.OutputProfile(self.out_folder, self.settings, self.source_tracks)
+        results = transcode.transcode_profiles([profile], Path.joinpath(self.root, 'reports'))[0]
+        self.assertTrue(all(result.ok for result in results))
+
+        filters = {}
+
+        with self.ffmpeg_log.open('rt') as fp:
+            for line in fp:
+                argv = json.loads(line)
+                filters[Path(argv[-1]).name] = argv[argv.index('-filter:a') + 1]
+
+        return filters
+
+    def test_rerun_after_deleted_output_uses_album_gain(self):
+        filters = self.transcode()
+        self.assertEqual(len(ALBUM_LOUDNESS), len(filters))
+        album_filter = filters['.01.partial.mp3']
+        self.assertTrue(all(value == album_filter for value in filters.values()))
+
+        Path.joinpath(self.out_folder, '02.mp3').unlink()
+
+        self.assertEqual({'.02.partial.mp3': album_filter}, self.transcode())
+
+
+
+class LoudnessCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_folder.name)
+
+    def tearDown(self):
+        self.temp_folder.cleanup()
+
+    def test_content_hash_computed_once_per_run(self):
+        source_file = Path.joinpath(self.root, 'track.flac')
+        source_file.write_bytes(b'source')
+        target = transcode.LoudnessTarget()
+        cache = transcode.LoudnessCache(Path.joinpath(self.root, 'loudnorm-cache.sqlite'), use_content_hash=True)
+
+        try:
+            with mock.patch.object(transcode, 'get_file_checksum', wraps=transcode.get_file_checksum) as checksum:
+                self.assertIsNone(cache.get(source_file, target))
+                cache.put(source_file, target, transcode.LoudnessMeasurement('-20.00', '-3.00', '5.00', '-30.00'))
+                self.assertEqual('-20.00', cache.get(source_file, target).input_i)
+        finally:
+            cache.close()
+
+        checksum.assert_called_once_with(source_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1583 @@
+# -*- coding: utf-8 -*-
+"""
+Общий код нормализации громкости и перекодирования треков для скриптов create-avto-playlist.py и create-sv-playlist.py.
+"""
+import asyncio
+import csv
+import hashlib
+import json
+import math
+import os
+import shlex
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import job_runner
+
+try:
+    import resource
+except ImportError:
+    # На Windows время процессора дочерних процессов недоступно, учитывается только время скрипта.
+    resource = None
+
+try:
+    import numpy as np
+    import ebur128
+except ImportError:
+    # Без numpy и scipy доступен только режим двух проходов ffmpeg.
+    np = None
+    ebur128 = None
+
+# Кэш измерений громкости, общий для всех скриптов.
+LOUDNESS_CACHE_PATH = Path.joinpath(Path.home(), '.cache', 'loudnorm-cache.sqlite')
+
+# Режимы нормализации громкости:
+# два прохода ffmpeg (измерение loudnorm и нормализация с перекодированием, трек декодируется дважды);
+# одно декодирование в PCM, измерение громкости в процессе и перекодирование PCM с вычисленным усилением.
+ENGINE_TWO_PASS = 'two-pass'
+ENGINE_SINGLE_DECODE = 'single-decode'
+
+# Режимы результата:
+# перекодирование с нормализацией громкости;
+# копирование аудиопотока исходного файла без перекодирования с записью усиления в теги ReplayGain/R128,
+# громкость выравнивает плеер.
+OUTPUT_ENCODE = 'encode'
+OUTPUT_GAIN_TAGS = 'gain-tags'
+
+# Режимы усиления: для каждого трека отдельно или общее для треков альбома, что сохраняет динамику альбома.
+GAIN_TRACK = 'track'
+GAIN_ALBUM = 'album'
+
+# Опорная громкость тега R128_TRACK_GAIN для Opus (RFC 7845).
+R128_REFERENCE = -23.0
+
+# Форматы контейнера MP4, в которые ffmpeg записывает нестандартные теги только с -movflags use_metadata_tags.
+MP4_SUFFIXES = ('.m4a', '.m4b', '.mp4', '.alac')
+
+# Расширения файлов результата, только такие файлы удаляются из каталога результата как ненужные.
+AUDIO_SUFFIXES = ('.mp3', '.aac', '.flac', '.ogg', '.opus', '.wav', '.aif', '.aiff', '.wma') + MP4_SUFFIXES
+# Доля не найденных исходных файлов, начиная с которой ненужные файлы не удаляются:
+# скорее всего недоступен сетевой диск с медиатекой, а не удалены треки.
+MISSING_SOURCES_LIMIT = 0.5
+
+# Формат PCM данных режима одного декодирования.
+PCM_SAMPLE_RATE = 44100
+PCM_CHANNELS = 2
+PCM_FORMAT = ['-f', 'f32le', '-ar', str(PCM_SAMPLE_RATE), '-ac', str(PCM_CHANNELS)]
+
+FFMPEG = ['ffmpeg', '-hide_banner', '-nostats', '-nostdin']
+FFPROBE = ['ffprobe', '-v', 'error']
+
+# Относительная стоимость декодирования по типу файла медиатеки iTunes или расширению файла.
+CODEC_COST_FACTORS = (
+    ('Lossless', 1.5),
+    ('.flac', 1.5),
+    ('.wav', 0.5),
+    ('.aif', 0.5),
+    ('.m4a', 1.2),
+    ('AAC', 1.2))
+
+# Относительная стоимость копирования аудиопотока в режиме записи тегов.
+COPY_COST_FACTOR = 0.05
+
+# Доля кодирования в стоимости обработки трека, при перекодировании для нескольких профилей
+# декодирование выполняется один раз, а кодирование для каждого профиля.
+ENCODE_COST_SHARE = 0.5
+
+# Каталог отчетов о запусках перекодирования.
+REPORT_FOLDER = Path.joinpath(Path.home(), '.cache', 'transcode-reports')
+# Число самых долгих треков в отчете.
+REPORT_SLOWEST_TRACKS = 10
+
+# Длительность, которая используется для оценки, если длительность трека определить не удалось.
+DEFAULT_DURATION = 240.0
+
+
+class LoudnessTarget:
+    """
+    Целевые параметры громкости фильтра loudnorm.
+    """
+
+    def __init__(self, i=-20.0, lra=7.0, tp=-2.0, offset=0.0):
+        self.i = i
+        self.lra = lra
+        self.tp = tp
+        self.offset = offset
+
+    def get_key(self):
+        return f'i={self.i}:lra={self.lra}:tp={self.tp}:offset={self.offset}'
+
+
+class LoudnessMeasurement:
+    """
+    Результат измерения громкости трека первым проходом loudnorm.
+    """
+
+    def __init__(self, input_i, input_tp, input_lra, input_thresh):
+        self.input_i = input_i
+        self.input_tp = input_tp
+        self.input_lra = input_lra
+        self.input_thresh = input_thresh
+
+
+class LoudnormOutputParser:
+    """
+    Разбирает вывод фильтра loudnorm построчно, сохраняя только блок JSON с результатом измерения.
+    """
+
+    def __init__(self):
+        self._in_loudnorm = False
+        self._json_lines = None
+        self.measurement = None
+
+    def feed(self, line):
+        if line.startswith('[Parsed_loudnorm'):
+            self._in_loudnorm = True
+            return
+
+        if not self._in_loudnorm:
+            return
+
+        if line.startswith('{'):
+            self._json_lines = []
+
+        if self._json_lines is None:
+            return
+
+        self._json_lines.append(line)
+
+        if line.startswith('}'):
+            values = json.loads('\n'.join(self._json_lines))
+            self.measurement = LoudnessMeasurement(
+                values.get('input_i'), values.get('input_tp'), values.get('input_lra'), values.get('input_thresh'))
+            self._in_loudnorm = False
+            self._json_lines = None
+
+
+def get_source_fingerprint(source_file: Path, use_content_hash=False):
+    """
+    Возвращает отпечаток исходного файла: размер, время модификации и, если требуется, SHA-1 содержимого.
+    """
+    stat = source_file.stat()
+    content_hash = get_file_checksum(source_file) if use_content_hash else ''
+
+    return stat.st_size, stat.st_mtime_ns, content_hash
+
+
+def get_file_checksum(file: Path):
+    sha1 = hashlib.sha1()
+
+    with file.open('rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def get_partial_file(destination_file: Path):
+    """
+    Возвращает временный файл, в который записывается результат до переименования.
+    Расширение сохраняется, по нему ffmpeg определяет формат результата.
+    """
+    return destination_file.with_name(f'.{destination_file.stem}.partial{destination_file.suffix}')
+
+
+class LoudnessCache:
+    """
+    Постоянный кэш измерений громкости в SQLite.
+    Ключ измерения: путь, размер, время модификации и хэш содержимого исходного файла, целевые параметры громкости.
+    """
+
+    def __init__(self, cache_path=None, use_content_hash=False):
+        self.cache_path = Path(cache_path or LOUDNESS_CACHE_PATH)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.use_content_hash = use_content_hash
+        # Измерения текущего запуска по исходному файлу (asyncio.Future), общие для всех профилей:
+        # измеренные значения не зависят от целевых параметров, поэтому трек измеряется один раз.
+        self.pending = {}
+        # Отпечатки исходных файлов текущего запуска: с хэшем содержимого файл читается целиком,
+        # поэтому отпечаток вычисляется один раз, а не при оценке стоимости, обработке и записи измерения.
+        self._fingerprints = {}
+
+        # Кэш может использоваться одновременно несколькими скриптами, поэтому ожидание блокировки увеличено.
+        self._connection = sqlite3.connect(str(self.cache_path), timeout=60)
+        self._connection.execute(
+            'create table if not exists measurements ('
+            'source_path text, size integer, mtime_ns integer, content_hash text, target text, '
+            'input_i text, input_tp text, input_lra text, input_thresh text, '
+            'primary key (source_path, target))')
+
+    def close(self):
+        self._connection.close()
+
+    def get_fingerprint(self, source_file: Path):
+        fingerprint = self._fingerprints.get(source_file)
+
+        if fingerprint is None:
+            fingerprint = get_source_fingerprint(source_file, self.use_content_hash)
+            self._fingerprints[source_file] = fingerprint
+
+        return fingerprint
+
+    def get(self, source_file: Path, target: LoudnessTarget):
+        row = self._connection.execute(
+            'select size, mtime_ns, content_hash, input_i, input_tp, input_lra, input_thresh '
+            'from measurements where source_path = ? and target = ?',
+            (source_file.as_posix(), target.get_key())).fetchone()
+
+        if row is None or tuple(row[:3]) != self.get_fingerprint(source_file):
+            return None
+
+        return LoudnessMeasurement(*row[3:])
+
+    def put(self, source_file: Path, target: LoudnessTarget, measurement: LoudnessMeasurement):
+        fingerprint = self.get_fingerprint(source_file)
+
+        with self._connection:
+            self._connection.execute(
+                'insert or replace into measurements '
+                '(source_path, size, mtime_ns, content_hash, target, input_i, input_tp, input_lra, input_thresh) '
+                'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (source_file.as_posix(), *fingerprint, target.get_key(),
+                 measurement.input_i, measurement.input_tp, measurement.input_lra, measurement.input_thresh))
+
+
+def get_linear_loudnorm_filter(target: LoudnessTarget, measurement: LoudnessMeasurement):
+    """
+    Возвращает фильтр второго прохода loudnorm с линейной нормализацией по измеренным значениям.
+    """
+    return f'loudnorm=linear=true' \
+        f':i={target.i}' \
+        f':lra={target.lra}' \
+        f':tp={target.tp}' \
+        f':offset={target.offset}' \
+        f':measured_I={measurement.input_i}' \
+        f':measured_LRA={measurement.input_lra}' \
+        f':measured_tp={measurement.input_tp}' \
+        f':measured_thresh={measurement.input_thresh}'
+
+
+def get_linear_gain(target: LoudnessTarget, measurement: LoudnessMeasurement):
+    """
+    Возвращает усиление в дБ для линейной нормализации, усиление ограничивается так,
+    чтобы истинный пик не превысил целевой.
+    """
+    if measurement.input_i is None:
+        return 0.0
+
+    gain = target.i + target.offset - float(measurement.input_i)
+
+    return min(gain, target.tp - float(measurement.input_tp))
+
+
+def get_album_measurement(album_measurements):
+    """
+    Возвращает громкость альбома по измерениям его треков: интегральная громкость усредняется по энергии
+    с учетом длительности треков, пик берется максимальный.
+
+    :param album_measurements: Пары (длительность в секундах, LoudnessMeasurement).
+    """
+    album_measurements = [
+        (duration, measurement) for duration, measurement in album_measurements if measurement.input_i is not None]
+
+    if not album_measurements:
+        return None
+
+    total_duration = sum(duration for duration, _ in album_measurements)
+    power = sum(duration * 10 ** (float(measurement.input_i) / 10) for duration, measurement in album_measurements)
+    album_i = 10 * math.log10(power / total_duration) if power > 0 else float(album_measurements[0][1].input_i)
+    album_tp = max(float(measurement.input_tp) for _, measurement in album_measurements)
+
+    return LoudnessMeasurement(f'{album_i:.2f}', f'{album_tp:.2f}', None, None)
+
+
+def get_gain_tags(target: LoudnessTarget, measurement: LoudnessMeasurement, suffix,
+                  album_measurement: LoudnessMeasurement = None):
+    """
+    Возвращает теги ReplayGain (и R128 для Opus) с усилением до целевой громкости.
+    Усиление по пику не ограничивается, для этого в теге передается пик трека.
+    """
+    tags = {}
+
+    for scope, scope_measurement in (('TRACK', measurement), ('ALBUM', album_measurement)):
+        if scope_measurement is None:
+            continue
+
+        input_i = float(scope_measurement.input_i)
+        gain = target.i + target.offset - input_i
+
+        tags[f'REPLAYGAIN_{scope}_GAIN'] = f'{gain:.2f} dB'
+        tags[f'REPLAYGAIN_{scope}_PEAK'] = f'{10 ** (float(scope_measurement.input_tp) / 20):.6f}'
+
+        if suffix == '.opus':
+            # Усиление Opus хранится в формате Q7.8 относительно -23 LUFS.
+            tags[f'R128_{scope}_GAIN'] = str(int(round((R128_REFERENCE - input_i) * 256)))
+
+    return tags
+
+
+def get_default_engine():
+    return ENGINE_SINGLE_DECODE if ebur128 is not None else ENGINE_TWO_PASS
+
+
+def analyze_pcm(pcm_file: Path):
+    """
+    Измеряет громкость PCM файла по EBU R128 без повторного декодирования.
+    Файл отображается в память, поэтому трек целиком в память не загружается.
+    """
+    if pcm_file.stat().st_size == 0:
+        return LoudnessMeasurement(None, None, None, None)
+
+    samples = np.memmap(pcm_file.as_posix(), dtype='<f4', mode='r').reshape(-1, PCM_CHANNELS)
+    result = ebur128.measure(samples, PCM_SAMPLE_RATE)
+
+    return LoudnessMeasurement(
+        f'{result.integrated:.2f}',
+        f'{result.true_peak:.2f}',
+        f'{result.loudness_range:.2f}',
+        f'{result.threshold:.2f}')
+
+
+def get_temp_pcm_file(temp_folder: Path):
+    temp_folder.mkdir(parents=True, exist_ok=True)
+    pcm_fd, pcm_path = tempfile.mkstemp(suffix='.f32le', dir=temp_folder.as_posix())
+    os.close(pcm_fd)
+
+    return Path(pcm_path)
+
+
+class TranscodeSettings:
+    """
+    Параметры нормализации громкости и перекодирования треков.
+    """
+
+    def __init__(self, target: LoudnessTarget, encode_options='-vn -acodec libmp3lame -ab 320k -ar 44100', engine=None,
+                 concurrency=None, timeout=30 * 60, use_content_hash=False, output_mode=OUTPUT_ENCODE, tag=None,
+                 encode_suffix='.mp3', passthrough_tolerance=None, passthrough_link=False, gain_mode=GAIN_TRACK,
+                 adaptive_concurrency=True, input_concurrency=None, output_concurrency=None, cache_path=None,
+                 temp_folder=None):
+        self.target = target
+        self.encode_options = encode_options
+        self.output_mode = output_mode
+        # Значение тега "Группировка", записываемого в файлы результата.
+        self.tag = tag
+        # Расширение файлов результата перекодирования, в режиме записи тегов сохраняется расширение исходного файла.
+        self.encode_suffix = encode_suffix
+        # Допуск в LU, в пределах которого трек в формате результата копируется без перекодирования,
+        # если не указан, то перекодируются все треки.
+        self.passthrough_tolerance = passthrough_tolerance
+        # Создавать жесткую ссылку на исходный файл вместо копирования.
+        self.passthrough_link = passthrough_link
+        self.gain_mode = gain_mode
+        self.engine = engine or get_default_engine()
+        # Число одновременно запущенных процессов ffmpeg, в адаптивном режиме - максимальное.
+        self.concurrency = concurrency or os.cpu_count() or 1
+        # Подстраивать число процессов под загрузку системы и ожидание ввода-вывода (исходные файлы на NAS,
+        # результат на SD карте).
+        self.adaptive_concurrency = adaptive_concurrency
+        # Ограничения числа процессов, читающих исходные файлы (декодирование, измерение),
+        # и процессов, записывающих результат (перекодирование, копирование).
+        self.input_concurrency = input_concurrency
+        self.output_concurrency = output_concurrency
+        # Максимальное время работы одного процесса ffmpeg в секундах.
+        self.timeout = timeout
+        self.use_content_hash = use_content_hash
+        # Файл кэша измерений громкости, по умолчанию LOUDNESS_CACHE_PATH.
+        self.cache_path = cache_path
+        # Каталог временных PCM файлов режима одного декодирования, по умолчанию каталог кэша громкости.
+        # PCM файл трека занимает около 21 МБ на минуту стерео 44.1 кГц, такой файл есть у каждого
+        # одновременно работающего процесса, поэтому /tmp (часто tmpfs в памяти) для этого не подходит.
+        self.temp_folder = temp_folder
+
+    def get_temp_folder(self):
+        return Path(self.temp_folder or Path(self.cache_path or LOUDNESS_CACHE_PATH).parent)
+
+    def get_key(self):
+        """
+        Параметры перекодирования для манифеста, при их изменении треки перекодируются заново.
+        """
+        if self.output_mode == OUTPUT_GAIN_TAGS:
+            key = f'{OUTPUT_GAIN_TAGS} {self.engine} {self.target.get_key()}'
+        else:
+            key = f'{self.engine} {self.target.get_key()} {self.encode_options}'
+
+        if self.tag:
+            key += f' tag={self.tag}'
+
+        if self.passthrough_tolerance is not None:
+            key += f' passthrough={self.passthrough_tolerance}'
+
+        if self.gain_mode == GAIN_ALBUM:
+            key += f' gain={GAIN_ALBUM}'
+
+        return key
+
+    def get_encode_arguments(self):
+        return shlex.split(self.encode_options)
+
+    def get_encode_format(self):
+        """
+        Возвращает (битрейт в кбит/с, частота дискретизации) из параметров кодирования.
+        """
+        arguments = self.get_encode_arguments()
+        bit_rate = None
+        sample_rate = None
+
+        for name, value in zip(arguments, arguments[1:]):
+            if name in ('-ab', '-b:a'):
+                bit_rate = int(value[:-1]) if value.lower().endswith('k') else int(value) // 1000
+            elif name == '-ar':
+                sample_rate = int(value)
+
+        return bit_rate, sample_rate
+
+    def is_passthrough_format(self, source_track):
+        """
+        Проверяет, что трек уже в формате результата и его можно не перекодировать, если громкость в допуске.
+        """
+        if self.passthrough_tolerance is None or self.output_mode != OUTPUT_ENCODE:
+            return False
+
+        return source_track.source_file.suffix.lower() == self.encode_suffix \
+            and (source_track.bit_rate, source_track.sample_rate) == self.get_encode_format()
+
+    def is_within_tolerance(self, measurement: LoudnessMeasurement):
+        if measurement.input_i is None:
+            return False
+
+        deviation = abs(float(measurement.input_i) - (self.target.i + self.target.offset))
+
+        return deviation <= self.passthrough_tolerance \
+            and float(measurement.input_tp) <= self.target.tp + self.passthrough_tolerance
+
+    def can_share_decode(self, source_track):
+        """
+        Проверяет, что трек можно перекодировать вместе с другими профилями из одного декодирования:
+        перекодирование с усилением трека, без копирования исходного файла.
+        """
+        return self.output_mode == OUTPUT_ENCODE and self.gain_mode == GAIN_TRACK \
+            and not self.is_passthrough_format(source_track)
+
+    def get_destination_suffix(self, source_file: Path):
+        if self.output_mode == OUTPUT_GAIN_TAGS:
+            return source_file.suffix.lower()
+
+        return self.encode_suffix
+
+
+class SourceTrack:
+    """
+    Исходный трек для перекодирования.
+
+    :param duration: Длительность в секундах из медиатеки, если не указана, то определяется ffprobe.
+    :param kind: Тип файла из медиатеки iTunes, например "Apple Lossless audio file".
+    :param bit_rate: Битрейт в кбит/с из медиатеки.
+    :param sample_rate: Частота дискретизации из медиатеки.
+    :param album: Альбом трека для режима усиления по альбому.
+    """
+
+    def __init__(self, source_file: Path, destination_name, duration=None, kind='', bit_rate=0, sample_rate=0,
+                 album=''):
+        self.source_file = source_file
+        self.destination_name = destination_name
+        self.duration = duration
+        self.kind = kind
+        self.bit_rate = bit_rate
+        self.sample_rate = sample_rate
+        self.album = album
+
+    def get_album_key(self):
+        """
+        Ключ альбома: альбомы с одинаковым названием различаются по каталогу исходных файлов.
+        Для трека без альбома возвращается None.
+        """
+        if not self.album:
+            return None
+
+        return self.album, self.source_file.parent.as_posix()
+
+
+def get_codec_cost_factor(source_track: SourceTrack):
+    for marker, factor in CODEC_COST_FACTORS:
+        if marker in source_track.kind or source_track.source_file.suffix.lower() == marker:
+            return factor
+
+    return 1.0
+
+
+class TrackResult:
+    """
+    Результат обработки трека: выполненные процессы и ошибка, если обработка не удалась.
+    """
+
+    def __init__(self, source_file: Path, destination_file: Path, priority=0.0, duration=None):
+        self.source_file = source_file
+        self.destination_file = destination_file
+        # Приоритет процессов трека, равен оценке стоимости обработки трека.
+        self.priority = priority
+        # Длительность трека в секундах.
+        self.duration = duration
+        self.processes = []
+        self.error = None
+        # Трек скопирован без перекодирования.
+        self.passthrough = False
+        # SHA-1 файла результата.
+        self.checksum = None
+        # Время измерения громкости и перекодирования (копирования), время ожидания запуска процессов.
+        self.analysis_seconds = 0.0
+        self.encode_seconds = 0.0
+        self.queue_wait = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # Число файлов результата, которые записывает тот же процесс ffmpeg (одно декодирование для профилей).
+        self.outputs = 1
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def get_work(self):
+        """
+        Объем работы процесса трека для подстройки числа процессов: длительность трека в секундах.
+        """
+        return self.duration or DEFAULT_DURATION
+
+    @property
+    def processing_seconds(self):
+        return self.analysis_seconds + self.encode_seconds
+
+    def get_realtime_factor(self):
+        """
+        Во сколько раз обработка быстрее воспроизведения трека.
+        """
+        if not self.duration or self.processing_seconds <= 0:
+            return None
+
+        return self.duration / self.processing_seconds
+
+    def add_timing(self, phase, seconds):
+        if phase == job_runner.PHASE_INPUT:
+            self.analysis_seconds += seconds
+        else:
+            self.encode_seconds += seconds
+
+    def add_process(self, process_result: job_runner.ProcessResult):
+        self.processes.append(process_result)
+        self.add_timing(process_result.phase, process_result.elapsed)
+        self.queue_wait += process_result.queue_wait
+
+        if not process_result.ok and self.error is None:
+            self.error = process_result.get_error()
+
+        return process_result.ok
+
+
+class TrackTranscoder:
+    """
+    Нормализация громкости и перекодирование треков процессами ffmpeg через общий JobRunner.
+    """
+
+    def __init__(self, settings: TranscodeSettings, runner: job_runner.JobRunner, cache: LoudnessCache,
+                 completed_handler=None):
+        self.settings = settings
+        self.runner = runner
+        self.cache = cache
+        # Функция, вызываемая с TrackResult сразу после успешной обработки трека.
+        self.completed_handler = completed_handler
+
+    async def analyze_loudness(self, source_file: Path, result: TrackResult):
+        """
+        Измеряет громкость трека первым проходом фильтра loudnorm, трек декодируется полностью.
+        """
+        target = self.settings.target
+        loudnorm_filter = f'loudnorm=print_format=json' \
+            f':i={target.i}' \
+            f':lra={target.lra}' \
+            f':tp={target.tp}' \
+            f':offset={target.offset}'
+
+        parser = LoudnormOutputParser()
+        argv = FFMPEG + ['-i', source_file.as_posix(), '-filter:a', loudnorm_filter, '-vn', '-sn', '-dn',
+                         '-f', 'null', os.devnull]
+
+        if not result.add_process(await self.runner.run(
+                argv, parser.feed, result.priority, phase=job_runner.PHASE_INPUT, work=result.get_work())):
+            return None
+
+        if parser.measurement is None or parser.measurement.input_i is None:
+            result.error = 'loudnorm measurement not found in ffmpeg output'
+            return None
+
+        return parser.measurement
+
+    async def analyze_decoded(self, source_file: Path, pcm_file: Path, result: TrackResult):
+        """
+        Декодирует трек в PCM файл и измеряет громкость PCM данных.
+        """
+        argv = FFMPEG + ['-loglevel', 'error', '-i', source_file.as_posix(),
+                         '-y', '-vn', '-sn', '-dn', *PCM_FORMAT, pcm_file.as_posix()]
+
+        process_result = await self.runner.run(
+            argv, priority=result.priority, phase=job_runner.PHASE_INPUT, work=result.get_work())
+
+        if not result.add_process(process_result):
+            return None
+
+        # Измерение выполняется в отдельном потоке, numpy и scipy освобождают GIL при вычислениях.
+        started = time.monotonic()
+        measurement = await asyncio.get_running_loop().run_in_executor(None, analyze_pcm, pcm_file)
+        result.add_timing(job_runner.PHASE_INPUT, time.monotonic() - started)
+
+        if measurement.input_i is None:
+            result.error = 'decoded audio is empty'
+            return None
+
+        return measurement
+
+    async def measure_once(self, source_file: Path, result: TrackResult, analyze):
+        """
+        Измеряет громкость трека один раз за запуск для всех профилей: если трек уже измеряется
+        для другого профиля, то ожидается то же измерение.
+        Возвращает (измерение, True если измерение выполнено этим вызовом).
+
+        :param analyze: Функция без параметров, возвращающая сопрограмму измерения.
+        """
+        future = self.cache.pending.get(source_file)
+
+        if future is not None:
+            measurement = await future
+
+            if measurement is None:
+                result.error = 'loudness measurement failed'
+            else:
+                self.cache.put(source_file, self.settings.target, measurement)
+
+            return measurement, False
+
+        future = asyncio.get_running_loop().create_future()
+        self.cache.pending[source_file] = future
+        measurement = None
+
+        try:
+            measurement = await analyze()
+        finally:
+            future.set_result(measurement)
+
+        if measurement is not None:
+            self.cache.put(source_file, self.settings.target, measurement)
+
+        return measurement, True
+
+    async def measure_loudness(self, source_file: Path, result: TrackResult):
+        """
+        Возвращает громкость трека из кэша, повторно громкость измеряется только для изменившихся файлов.
+        """
+        measurement = self.cache.get(source_file, self.settings.target)
+
+        if measurement is not None:
+            return measurement
+
+        async def analyze():
+            if self.settings.engine != ENGINE_SINGLE_DECODE:
+                return await self.analyze_loudness(source_file, result)
+
+            pcm_file = get_temp_pcm_file(self.settings.get_temp_folder())
+
+            try:
+                return await self.analyze_decoded(source_file, pcm_file, result)
+            finally:
+                pcm_file.unlink()
+
+        measurement, _ = await self.measure_once(source_file, result, analyze)
+
+        return measurement
+
+    def get_gain_filter(self, measurement: LoudnessMeasurement):
+        """
+        Фильтр нормализации громкости трека, зависит только от режима профиля, а не от способа декодирования:
+        loudnorm с линейной нормализацией для двух проходов (при упоре в истинный пик loudnorm сам переходит
+        в динамический режим) или усиление volume с ограничением по истинному пику для одного декодирования.
+        """
+        if self.settings.engine == ENGINE_SINGLE_DECODE:
+            return f'volume={get_linear_gain(self.settings.target, measurement):.2f}dB'
+
+        return get_linear_loudnorm_filter(self.settings.target, measurement)
+
+    def get_metadata_arguments(self, destination_file: Path, measurement: LoudnessMeasurement = None,
+                               album_measurement: LoudnessMeasurement = None):
+        """
+        Аргументы ffmpeg для записи тега группировки и, если передано измерение, тегов усиления.
+        """
+        tags = {}
+
+        if self.settings.tag:
+            tags['grouping'] = self.settings.tag
+
+        if measurement is not None:
+            tags.update(get_gain_tags(
+                self.settings.target, measurement, destination_file.suffix.lower(), album_measurement))
+
+        arguments = []
+
+        for name, value in tags.items():
+            arguments += ['-metadata', f'{name}={value}']
+
+        if arguments and destination_file.suffix.lower() in MP4_SUFFIXES:
+            arguments += ['-movflags', 'use_metadata_tags']
+
+        return arguments
+
+    async def copy_source(self, source_file: Path, destination_file: Path, result: TrackResult):
+        """
+        Копирует исходный файл без перекодирования.
+        Если задан тег группировки, то аудиопоток копируется ffmpeg с записью тега.
+        """
+        result.passthrough = True
+
+        if self.settings.tag:
+            argv = FFMPEG + ['-loglevel', 'error', '-i', source_file.as_posix(),
+                             '-y', '-map', '0:a', '-c:a', 'copy',
+                             *self.get_metadata_arguments(destination_file), destination_file.as_posix()]
+            result.add_process(await self.runner.run(
+                argv, priority=result.priority, phase=job_runner.PHASE_OUTPUT, work=result.get_work()))
+            return
+
+        if self.settings.passthrough_link:
+            try:
+                os.link(source_file.as_posix(), destination_file.as_posix())
+                return
+            except OSError:
+                # Каталог результата на другом разделе, файл копируется.
+                pass
+
+        started = time.monotonic()
+        await self.runner.call(
+            shutil.copyfile, source_file.as_posix(), destination_file.as_posix(),
+            priority=result.priority, phase=job_runner.PHASE_OUTPUT)
+        result.add_timing(job_runner.PHASE_OUTPUT, time.monotonic() - started)
+
+    async def process_two_pass(self, source_file: Path, destination_file: Path, result: TrackResult,
+                               passthrough=False):
+        measurement = await self.measure_loudness(source_file, result)
+
+        if measurement is None:
+            return
+
+        if passthrough and self.settings.is_within_tolerance(measurement):
+            await self.copy_source(source_file, destination_file, result)
+            return
+
+        argv = FFMPEG + ['-loglevel', 'error', '-i', source_file.as_posix(),
+                         '-y', '-filter:a', self.get_gain_filter(measurement),
+                         *self.settings.get_encode_arguments(), *self.get_metadata_arguments(destination_file),
+                         destination_file.as_posix()]
+        result.add_process(await self.runner.run(
+            argv, priority=result.priority, phase=job_runner.PHASE_OUTPUT, work=result.get_work()))
+
+    async def process_single_decode(self, source_file: Path, destination_file: Path, result: TrackResult,
+                                    passthrough=False):
+        measurement = self.cache.get(source_file, self.settings.target)
+
+        if measurement is None:
+            # Трек декодируется один раз во временный PCM файл, который используется и для измерения,
+            # и для перекодирования. Теги берутся из исходного файла.
+            pcm_file = get_temp_pcm_file(self.settings.get_temp_folder())
+
+            try:
+                measurement, decoded = await self.measure_once(
+                    source_file, result, lambda: self.analyze_decoded(source_file, pcm_file, result))
+
+                if measurement is None:
+                    return
+
+                if decoded:
+                    if passthrough and self.settings.is_within_tolerance(measurement):
+                        await self.copy_source(source_file, destination_file, result)
+                        return
+
+                    argv = FFMPEG + ['-loglevel', 'error', *PCM_FORMAT, '-i', pcm_file.as_posix(),
+                                     '-i', source_file.as_posix(), '-map', '0:a', '-map_metadata', '1',
+                                     '-y', '-filter:a', self.get_gain_filter(measurement),
+                                     *self.settings.get_encode_arguments(),
+                                     *self.get_metadata_arguments(destination_file), destination_file.as_posix()]
+                    result.add_process(await self.runner.run(
+                        argv, priority=result.priority, phase=job_runner.PHASE_OUTPUT, work=result.get_work()))
+                    return
+            finally:
+                if pcm_file.exists():
+                    pcm_file.unlink()
+
+        if passthrough and self.settings.is_within_tolerance(measurement):
+            await self.copy_source(source_file, destination_file, result)
+            return
+
+        # Громкость уже измерена, трек декодируется один раз при перекодировании.
+        argv = FFMPEG + ['-loglevel', 'error', '-i', source_file.as_posix(),
+                         '-y', '-filter:a', self.get_gain_filter(measurement),
+                         *self.settings.get_encode_arguments(), *self.get_metadata_arguments(destination_file),
+                         destination_file.as_posix()]
+        result.add_process(await self.runner.run(
+            argv, priority=result.priority, phase=job_runner.PHASE_OUTPUT, work=result.get_work()))
+
+    async def process_gain_tags(self, source_file: Path, destination_file: Path, result: TrackResult,
+                                album_measurement: LoudnessMeasurement = None):
+        measurement = await self.measure_loudness(source_file, result)
+
+        if measurement is None:
+            return
+
+        # Аудиопоток копируется без перекодирования, громкость выравнивает плеер по тегам.
+        argv = FFMPEG + ['-loglevel', 'error', '-i', source_file.as_posix(),
+                         '-y', '-map', '0:a', '-c:a', 'copy',
+                         *self.get_metadata_arguments(destination_file, measurement, album_measurement),
+                         destination_file.as_posix()]
+        result.add_process(await self.runner.run(
+            argv, priority=result.priority, phase=job_runner.PHASE_OUTPUT, work=result.get_work()))
+
+    async def process_album_encode(self, source_file: Path, destination_file: Path, result: TrackResult,
+                                   album_measurement: LoudnessMeasurement, passthrough=False):
+        # Трек альбома перекодируется с общим для альбома усилением.
+        if passthrough and self.settings.is_within_tolerance(album_measurement):
+            await self.copy_source(source_file, destination_file, result)
+            return
+
+        argv = FFMPEG + ['-loglevel', 'error', '-i', source_file.as_posix(),
+                         '-y', '-filter:a', f'volume={get_linear_gain(self.settings.target, album_measurement):.2f}dB',
+                         *self.settings.get_encode_arguments(), *self.get_metadata_arguments(destination_file),
+                         destination_file.as_posix()]
+        result.add_process(await self.runner.run(
+            argv, priority=result.priority, phase=job_runner.PHASE_OUTPUT, work=result.get_work()))
+
+    async def process_album(self, album_jobs, album_tracks=None):
+        """
+        Обрабатывает треки альбома с общим усилением, возвращает список TrackResult.
+        Громкость всех треков альбома измеряется одновременно, затем треки перекодируются параллельно.
+
+        :param album_jobs: Тройки (стоимость, SourceTrack, файл результата) треков, которые нужно перекодировать.
+        :param album_tracks: Все треки альбома в профиле, по умолчанию только перекодируемые треки.
+            Усиление альбома вычисляется по всем трекам, иначе перекодированный заново трек (удаленный файл
+            результата, повтор после ошибки) получил бы другое усиление, чем остальные треки альбома.
+            Громкость неизменившихся треков берется из кэша.
+        """
+        results = [TrackResult(source_track.source_file, destination_file, cost, source_track.duration)
+                   for cost, source_track, destination_file in album_jobs]
+
+        # Неизменившиеся треки только измеряются, их результаты не возвращаются и файлы результата не трогаются.
+        job_names = {source_track.destination_name for _, source_track, _ in album_jobs}
+        other_tracks = [source_track for source_track in album_tracks or []
+                        if source_track.destination_name not in job_names]
+        await probe_durations(self.runner, other_tracks)
+        out_folder = album_jobs[0][2].parent
+        other_results = [
+            TrackResult(source_track.source_file, Path.joinpath(out_folder, source_track.destination_name),
+                        duration=source_track.duration)
+            for source_track in other_tracks]
+
+        measurements = await asyncio.gather(*(
+            self.measure_loudness(result.source_file, result) for result in results + other_results))
+
+        album_measurement = get_album_measurement(
+            (result.duration or DEFAULT_DURATION, measurement)
+            for result, measurement in zip(results + other_results, measurements)
+            if measurement is not None)
+
+        if album_measurement is None:
+            return results
+
+        # Треки с неудачным измерением громкости не перекодируются, их ошибка уже в результате.
+        processed = await asyncio.gather(*(
+            self.process_track(source_track, destination_file, cost, album_measurement, result)
+            for (cost, source_track, destination_file), result in zip(album_jobs, results)
+            if result.ok))
+
+        return [result for result in results if not result.ok] + processed
+
+    async def process_track(self, source_track: SourceTrack, destination_file: Path, priority=0.0,
+                            album_measurement: LoudnessMeasurement = None, result: TrackResult = None):
+        """
+        Нормализует громкость и перекодирует трек, возвращает TrackResult.
+
+        :param album_measurement: Громкость альбома, если указана, то используется общее для альбома усиление.
+        :param result: Результат, в который добавляются процессы, если трек уже обрабатывался (измерение альбома).
+        """
+        source_file = source_track.source_file
+        # Трек уже в формате результата, после измерения громкости он может быть скопирован без перекодирования.
+        passthrough = self.settings.is_passthrough_format(source_track)
+        result = result or TrackResult(source_file, destination_file, priority, source_track.duration)
+
+        # Результат записывается во временный файл и переименовывается только после успешной обработки,
+        # поэтому прерванная обработка не оставляет неполный файл под именем результата.
+        partial_file = get_partial_file(destination_file)
+
+        if partial_file.exists():
+            partial_file.unlink()
+
+        print(f'Process {source_file.as_posix()} to {destination_file.as_posix()} ...')
+
+        if self.settings.output_mode == OUTPUT_GAIN_TAGS:
+            await self.process_gain_tags(source_file, partial_file, result, album_measurement)
+        elif album_measurement is not None:
+            await self.process_album_encode(source_file, partial_file, result, album_measurement, passthrough)
+        elif self.settings.engine == ENGINE_SINGLE_DECODE:
+            await self.process_single_decode(source_file, partial_file, result, passthrough)
+        else:
+            await self.process_two_pass(source_file, partial_file, result, passthrough)
+
+        return await self.complete_track(result, partial_file, destination_file)
+
+    async def complete_track(self, result: TrackResult, partial_file: Path, destination_file: Path):
+        """
+        Переименовывает временный файл в файл результата после успешной обработки, иначе удаляет его.
+        """
+        if result.ok and not partial_file.exists():
+            result.error = 'output file was not created'
+
+        if not result.ok:
+            # Старый результат тоже удаляется, чтобы не остался устаревший файл.
+            for file in (partial_file, destination_file):
+                if file.exists():
+                    file.unlink()
+
+            return result
+
+        result.checksum = await self.runner.call(
+            get_file_checksum, partial_file, priority=result.priority, phase=job_runner.PHASE_OUTPUT)
+        os.replace(partial_file.as_posix(), destination_file.as_posix())
+        result.bytes_read = result.source_file.stat().st_size
+        result.bytes_written = destination_file.stat().st_size
+
+        if self.completed_handler is not None:
+            self.completed_handler(result)
+
+        return result
+
+
+class CompletionJournal:
+    """
+    Журнал обработанных треков каталога результата, запись дописывается сразу после обработки трека.
+    Если запуск прерван, то следующий запуск берет обработанные треки из журнала и продолжает с места остановки.
+    После сохранения манифеста журнал удаляется.
+    """
+
+    FILE_NAME = '.journal.jsonl'
+
+    def __init__(self, out_folder: Path):
+        self.journal_file = Path.joinpath(out_folder, self.FILE_NAME)
+        self._fp = None
+
+    def read(self):
+        records = []
+
+        if not self.journal_file.exists():
+            return records
+
+        with self.journal_file.open('rt', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Последняя запись могла быть записана не полностью при прерывании.
+                    break
+
+        return records
+
+    def append(self, destination_name, entry, checksum):
+        if self._fp is None:
+            self._fp = self.journal_file.open('at', encoding='utf-8')
+
+        self._fp.write(json.dumps({'name': destination_name, 'entry': entry, 'checksum': checksum},
+                                  ensure_ascii=False) + '\n')
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def remove(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+        if self.journal_file.exists():
+            self.journal_file.unlink()
+
+
+class OutputManifest:
+    """
+    Манифест каталога с результатами перекодирования.
+    Для каждого файла результата хранится исходный файл, его отпечаток и параметры перекодирования,
+    что позволяет перекодировать только новые и изменившиеся треки, а также SHA-1 файла результата
+    для синхронизации с устройством.
+    """
+
+    FILE_NAME = '.manifest.json'
+
+    def __init__(self, out_folder: Path):
+        self.out_folder = out_folder
+        self.manifest_file = Path.joinpath(out_folder, self.FILE_NAME)
+        self.entries = {}
+
+        if self.manifest_file.exists():
+            with self.manifest_file.open('rt', encoding='utf-8') as fp:
+                self.entries = json.load(fp)
+
+    @staticmethod
+    def get_entry(source_file: Path, parameters):
+        size, mtime_ns, _ = get_source_fingerprint(source_file)
+
+        return {'source': source_file.as_posix(), 'size': size, 'mtime_ns': mtime_ns, 'parameters': parameters}
+
+    def is_current(self, destination_name, entry):
+        stored_entry = self.entries.get(destination_name)
+
+        # Контрольная сумма результата в отпечаток исходного файла не входит.
+        return stored_entry is not None \
+            and all(stored_entry.get(key) == value for key, value in entry.items()) \
+            and Path.joinpath(self.out_folder, destination_name).exists()
+
+    def set_entry(self, destination_name, entry, checksum):
+        self.entries[destination_name] = {**entry, 'checksum': checksum}
+
+    def apply_journal(self, records):
+        """
+        Добавляет в манифест треки из журнала прерванного запуска, если файл результата не изменился.
+        Возвращает число добавленных треков.
+        """
+        applied = 0
+
+        for record in records:
+            destination_file = Path.joinpath(self.out_folder, record['name'])
+
+            if destination_file.exists() and get_file_checksum(destination_file) == record['checksum']:
+                self.set_entry(record['name'], record['entry'], record['checksum'])
+                applied += 1
+
+        return applied
+
+    def save(self):
+        temp_file = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+
+        with temp_file.open('wt', encoding='utf-8') as fp:
+            json.dump(self.entries, fp, ensure_ascii=False, indent=1, sort_keys=True)
+
+        os.replace(temp_file.as_posix(), self.manifest_file.as_posix())
+
+    def remove_obsolete(self, destination_names):
+        """
+        Удаляет файлы результата и записи манифеста, которые больше не нужны.
+        Удаляются только аудио файлы, остальные файлы и каталоги остаются.
+        """
+        for destination_file in self.out_folder.iterdir():
+            if destination_file.name in destination_names \
+                    or destination_file.suffix.lower() not in AUDIO_SUFFIXES \
+                    or not destination_file.is_file():
+                continue
+
+            print(f'Remove {destination_file.as_posix()}')
+            destination_file.unlink()
+
+        for destination_name in list(self.entries):
+            if destination_name not in destination_names:
+                del self.entries[destination_name]
+
+
+async def probe_duration(runner: job_runner.JobRunner, source_file: Path):
+    argv = FFPROBE + ['-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
+                      source_file.as_posix()]
+    result = await runner.run(argv, capture_stdout=True, phase=job_runner.PHASE_INPUT)
+
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+
+async def probe_durations(runner: job_runner.JobRunner, source_tracks):
+    """
+    Определяет ffprobe длительность треков, для которых она не указана в медиатеке.
+    """
+    unknown = [source_track for source_track in source_tracks if not source_track.duration]
+    durations = await asyncio.gather(*(probe_duration(runner, track.source_file) for track in unknown))
+
+    for source_track, duration in zip(unknown, durations):
+        source_track.duration = duration
+
+
+async def estimate_costs(source_tracks, runner: job_runner.JobRunner, cache: LoudnessCache, settings):
+    """
+    Оценивает стоимость обработки треков: длительность с учетом типа файла и числа проходов декодирования.
+    Длительность берется из медиатеки, для треков без длительности определяется ffprobe.
+    """
+    await probe_durations(runner, source_tracks)
+    costs = []
+
+    for source_track in source_tracks:
+        cost = (source_track.duration or DEFAULT_DURATION) * get_codec_cost_factor(source_track)
+        measurement = cache.get(source_track.source_file, settings.target)
+        measured = measurement is not None
+
+        if measured and settings.is_passthrough_format(source_track) and settings.is_within_tolerance(measurement):
+            # Трек будет скопирован без перекодирования.
+            cost *= COPY_COST_FACTOR
+        elif settings.output_mode == OUTPUT_GAIN_TAGS:
+            # Трек декодируется только для измерения громкости, затем поток копируется.
+            if measured:
+                cost *= COPY_COST_FACTOR
+        elif settings.engine == ENGINE_TWO_PASS and not measured:
+            # Для треков без измеренной громкости в режиме двух проходов трек декодируется дважды.
+            cost *= 2
+
+        costs.append(cost)
+
+    return costs
+
+
+def group_by_album(source_tracks):
+    """
+    Возвращает словарь списков треков по ключу альбома, треки без альбома в словарь не попадают.
+    """
+    albums = {}
+
+    for source_track in source_tracks:
+        album_key = source_track.get_album_key()
+
+        if album_key is not None:
+            albums.setdefault(album_key, []).append(source_track)
+
+    return albums
+
+
+async def _process_albums(transcoder: TrackTranscoder, jobs, out_folder: Path, album_tracks):
+    # Альбомы обрабатываются одновременно, процессы всех альбомов конкурируют за слоты в порядке стоимости,
+    # поэтому измерение альбома не выполняется последовательно.
+    # album_tracks - все треки профиля по ключу альбома, по ним вычисляется усиление альбома.
+    album_jobs = {}
+    track_jobs = []
+
+    for cost, source_track in jobs:
+        job = cost, source_track, Path.joinpath(out_folder, source_track.destination_name)
+        album_key = source_track.get_album_key()
+
+        if album_key is None:
+            track_jobs.append(job)
+        else:
+            album_jobs.setdefault(album_key, []).append(job)
+
+    album_results = await asyncio.gather(
+        *(transcoder.process_album(jobs, album_tracks.get(album_key)) for album_key, jobs in album_jobs.items()),
+        *(transcoder.process_track(*job) for job in track_jobs))
+
+    results = []
+
+    for album_result in album_results[:len(album_jobs)]:
+        results += album_result
+
+    return results + album_results[len(album_jobs):]
+
+
+def get_shared_cost(costs):
+    return max(costs) + ENCODE_COST_SHARE * (sum(costs) - max(costs))
+
+
+async def process_shared_decode(jobs):
+    """
+    Перекодирует трек для нескольких профилей одним процессом ffmpeg: трек декодируется один раз,
+    декодированный звук подается на выходы профилей, у каждого выхода свое усиление и параметры кодирования.
+    Возвращает список TrackResult.
+
+    :param jobs: Четверки (стоимость, TrackTranscoder, SourceTrack, файл результата) одного исходного файла.
+    """
+    priority = get_shared_cost([cost for cost, _, _, _ in jobs])
+    _, transcoder, source_track, _ = jobs[0]
+    source_file = source_track.source_file
+    results = [TrackResult(source_file, destination_file, priority, source_track.duration)
+               for _, _, _, destination_file in jobs]
+    partial_files = [get_partial_file(destination_file) for _, _, _, destination_file in jobs]
+
+    for partial_file in partial_files:
+        if partial_file.exists():
+            partial_file.unlink()
+
+    print(f'Process {source_file.as_posix()} to '
+          f'{", ".join(destination_file.as_posix() for _, _, _, destination_file in jobs)} ...')
+
+    # Измеренные значения громкости не зависят от целевых параметров, поэтому измерение общее для всех профилей.
+    measurement = None
+
+    for _, job_transcoder, _, _ in jobs:
+        measurement = job_transcoder.cache.get(source_file, job_transcoder.settings.target)
+
+        if measurement is not None:
+            break
+
+    pcm_file = None
+
+    try:
+        if measurement is None:
+            if transcoder.settings.engine == ENGINE_SINGLE_DECODE:
+                # PCM файл используется и для измерения, и как вход перекодирования для всех профилей.
+                pcm_file = get_temp_pcm_file(transcoder.settings.get_temp_folder())
+                measurement, decoded = await transcoder.measure_once(
+                    source_file, results[0], lambda: transcoder.analyze_decoded(source_file, pcm_file, results[0]))
+
+                if not decoded:
+                    pcm_file.unlink()
+                    pcm_file = None
+            else:
+                measurement = await transcoder.measure_loudness(source_file, results[0])
+
+        if measurement is None:
+            for result in results[1:]:
+                result.error = results[0].error
+
+            return results
+
+        for _, job_transcoder, _, _ in jobs:
+            job_transcoder.cache.put(source_file, job_transcoder.settings.target, measurement)
+
+        if pcm_file is not None:
+            inputs = [*PCM_FORMAT, '-i', pcm_file.as_posix(), '-i', source_file.as_posix()]
+            mapping = ['-map', '0:a', '-map_metadata', '1']
+        else:
+            inputs = ['-i', source_file.as_posix()]
+            mapping = ['-map', '0:a']
+
+        argv = FFMPEG + ['-loglevel', 'error', *inputs, '-y']
+
+        for (_, job_transcoder, _, _), partial_file in zip(jobs, partial_files):
+            # Фильтр громкости тот же, что при перекодировании трека для одного профиля,
+            # поэтому результат не зависит от числа профилей, в которые входит трек.
+            argv += [*mapping, '-filter:a', job_transcoder.get_gain_filter(measurement),
+                     *job_transcoder.settings.get_encode_arguments(),
+                     *job_transcoder.get_metadata_arguments(partial_file), partial_file.as_posix()]
+
+        process_result = await transcoder.runner.run(
+            argv, priority=priority, phase=job_runner.PHASE_OUTPUT, work=results[0].get_work())
+
+        for result in results:
+            result.add_process(process_result)
+            result.outputs = len(results)
+    finally:
+        if pcm_file is not None:
+            pcm_file.unlink()
+
+    return [
+        await job_transcoder.complete_track(result, partial_file, destination_file)
+        for (_, job_transcoder, _, destination_file), result, partial_file in zip(jobs, results, partial_files)]
+
+
+class OutputProfile:
+    """
+    Профиль результата: каталог, параметры кодирования и громкости, треки.
+    """
+
+    def __init__(self, out_folder: Path, settings: TranscodeSettings, source_tracks):
+        self.out_folder = out_folder
+        self.settings = settings
+        self.source_tracks = source_tracks
+
+
+class ProfileBatch:
+    """
+    Обработка профиля в запуске: манифест и журнал каталога результата, список новых и изменившихся треков.
+    """
+
+    def __init__(self, profile: OutputProfile):
+        self.profile = profile
+        self.out_folder = profile.out_folder
+        self.out_folder.mkdir(parents=True, exist_ok=True)
+
+        self.manifest = OutputManifest(self.out_folder)
+        self.journal = CompletionJournal(self.out_folder)
+        resumed = self.manifest.apply_journal(self.journal.read())
+
+        if resumed:
+            print(f'Resumed tracks from interrupted run: {resumed}')
+
+        # Журнал переносится в манифест, новый запуск начинает журнал заново.
+        self.manifest.save()
+        self.journal.remove()
+
+        self.entries = {}
+        self.changed_tracks = []
+        # Все найденные треки профиля по ключу альбома для режима усиления по альбому.
+        self.album_tracks = {}
+        self._find_changed_tracks()
+
+    def _find_changed_tracks(self):
+        settings = self.profile.settings
+        parameters = settings.get_key()
+        existing_tracks = []
+        missing_names = set()
+
+        for source_track in self.profile.source_tracks:
+            if not source_track.source_file.exists():
+                print(f'Source file not found {source_track.source_file.as_posix()}')
+                missing_names.add(source_track.destination_name)
+                continue
+
+            existing_tracks.append(source_track)
+
+        album_parameters = {}
+
+        if settings.gain_mode == GAIN_ALBUM:
+            self.album_tracks = group_by_album(existing_tracks)
+
+            # Усиление альбома зависит от всех его треков, поэтому в параметры трека входит отпечаток альбома:
+            # при изменении или добавлении любого трека альбом обрабатывается заново целиком.
+            for album_key, album_tracks in self.album_tracks.items():
+                album_fingerprint = sorted(
+                    (track.source_file.as_posix(), *get_source_fingerprint(track.source_file)[:2])
+                    for track in album_tracks)
+                album_hash = hashlib.sha1(json.dumps(album_fingerprint).encode('utf-8')).hexdigest()
+                album_parameters[album_key] = f'{parameters} album={album_hash}'
+
+        for source_track in existing_tracks:
+            entry = self.manifest.get_entry(
+                source_track.source_file, album_parameters.get(source_track.get_album_key(), parameters))
+            self.entries[source_track.destination_name] = entry
+
+            if not self.manifest.is_current(source_track.destination_name, entry):
+                self.changed_tracks.append(source_track)
+
+        if missing_names and (not existing_tracks
+                              or len(missing_names) > len(self.profile.source_tracks) * MISSING_SOURCES_LIMIT):
+            print(f'Source files not found: {len(missing_names)} of {len(self.profile.source_tracks)}, '
+                  f'obsolete files are not removed')
+        else:
+            # Результат трека, исходный файл которого временно недоступен, сохраняется вместе с записью манифеста.
+            self.manifest.remove_obsolete(self.entries.keys() | missing_names)
+
+        print(f'Tracks to process in {self.out_folder.as_posix()}: '
+              f'{len(self.changed_tracks)} of {len(self.profile.source_tracks)}')
+
+    def get_destination_file(self, source_track: SourceTrack):
+        return Path.joinpath(self.out_folder, source_track.destination_name)
+
+    def on_completed(self, result: TrackResult):
+        self.journal.append(
+            result.destination_file.name, self.entries[result.destination_file.name], result.checksum)
+
+    def finish(self, results):
+        for result in results:
+            if result.ok:
+                self.manifest.set_entry(
+                    result.destination_file.name, self.entries[result.destination_file.name], result.checksum)
+            else:
+                print(f'Failed {result.source_file.as_posix()}: {result.error}')
+
+        self.manifest.save()
+        self.journal.remove()
+
+        if self.profile.settings.passthrough_tolerance is not None:
+            print(f'Encodes avoided in {self.out_folder.as_posix()}: '
+                  f'{sum(1 for result in results if result.ok and result.passthrough)}')
+
+
+def get_cpu_seconds():
+    """
+    Время процессора скрипта и завершившихся дочерних процессов.
+    """
+    if resource is None:
+        return time.process_time()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+class RunReport:
+    """
+    Отчет о запуске перекодирования: показатели каждого трека и итоги запуска.
+    Записывается в JSON (итоги и треки) и CSV (треки) для сравнения запусков.
+    """
+
+    CSV_FIELDS = (
+        'source', 'destination', 'ok', 'error', 'duration', 'analysis_seconds', 'encode_seconds', 'queue_wait',
+        'realtime_factor', 'bytes_read', 'bytes_written', 'passthrough', 'outputs')
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self._started = time.monotonic()
+        self._cpu_started = get_cpu_seconds()
+        self.summary = {}
+        self.tracks = []
+
+    @staticmethod
+    def get_track_row(result: TrackResult):
+        realtime_factor = result.get_realtime_factor()
+
+        return {
+            'source': result.source_file.as_posix(),
+            'destination': result.destination_file.as_posix(),
+            'ok': result.ok,
+            'error': result.error or '',
+            'duration': round(result.duration or 0.0, 3),
+            'analysis_seconds': round(result.analysis_seconds, 3),
+            'encode_seconds': round(result.encode_seconds, 3),
+            'queue_wait': round(result.queue_wait, 3),
+            'realtime_factor': round(realtime_factor, 2) if realtime_factor is not None else '',
+            'bytes_read': result.bytes_read,
+            'bytes_written': result.bytes_written,
+            'passthrough': result.passthrough,
+            'outputs': result.outputs}
+
+    def finish(self, results, runner: job_runner.JobRunner):
+        wall_seconds = time.monotonic() - self._started
+        completed = [result for result in results if result.ok]
+        audio_seconds = sum(result.duration or 0.0 for result in completed)
+        slowest = sorted(results, key=lambda result: result.processing_seconds, reverse=True)
+
+        self.tracks = [self.get_track_row(result) for result in results]
+        self.summary = {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'tracks': len(results),
+            'failed': len(results) - len(completed),
+            'wall_seconds': round(wall_seconds, 3),
+            'tracks_per_second': round(len(completed) / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+            'realtime_factor': round(audio_seconds / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+            'cpu_seconds': round(get_cpu_seconds() - self._cpu_started, 3),
+            'process_seconds': round(runner.busy_seconds, 3),
+            'queue_wait_seconds': round(runner.queue_wait_seconds, 3),
+            'bytes_read': sum(result.bytes_read for result in completed),
+            'bytes_written': sum(result.bytes_written for result in completed),
+            'slowest': [self.get_track_row(result) for result in slowest[:REPORT_SLOWEST_TRACKS]]}
+
+    def print_summary(self):
+        print(f'Tracks: {self.summary["tracks"]}, failed: {self.summary["failed"]}, '
+              f'tracks/s: {self.summary["tracks_per_second"]}, realtime factor: {self.summary["realtime_factor"]}, '
+              f'CPU time: {self.summary["cpu_seconds"]:.1f} s, queue wait: {self.summary["queue_wait_seconds"]:.1f} s')
+
+        for row in self.summary['slowest'][:3]:
+            print(f'Slow: {row["source"]} analysis {row["analysis_seconds"]:.1f} s, '
+                  f'encode {row["encode_seconds"]:.1f} s')
+
+    def save(self, report_folder: Path = None):
+        """
+        Записывает отчет в файлы transcode-<время запуска>.json и .csv, возвращает путь к JSON файлу.
+        """
+        report_folder = Path(report_folder or REPORT_FOLDER)
+        report_folder.mkdir(parents=True, exist_ok=True)
+        report_file = Path.joinpath(report_folder, f'transcode-{self.started_at:%Y%m%d-%H%M%S}.json')
+
+        with report_file.open('wt', encoding='utf-8') as fp:
+            json.dump({'summary': self.summary, 'tracks': self.tracks}, fp, ensure_ascii=False, indent=1)
+
+        with report_file.with_suffix('.csv').open('wt', encoding='utf-8', newline='') as fp:
+            writer = csv.DictWriter(fp, self.CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.tracks)
+
+        return report_file
+
+
+async def _transcode_profiles(batches, report: RunReport):
+    # Параметры запуска процессов берутся из первого профиля.
+    settings = batches[0].profile.settings
+    runner = job_runner.JobRunner(
+        settings.concurrency, settings.timeout, settings.adaptive_concurrency,
+        {job_runner.PHASE_INPUT: settings.input_concurrency, job_runner.PHASE_OUTPUT: settings.output_concurrency})
+    cache = LoudnessCache(settings.cache_path, any(batch.profile.settings.use_content_hash for batch in batches))
+
+    try:
+        # Задания: (стоимость, сопрограмма обработки).
+        jobs = []
+        shared_jobs = {}
+
+        for batch in batches:
+            batch_settings = batch.profile.settings
+            transcoder = TrackTranscoder(batch_settings, runner, cache, batch.on_completed)
+            costs = await estimate_costs(batch.changed_tracks, runner, cache, batch_settings)
+            batch_jobs = sorted(zip(costs, batch.changed_tracks), key=lambda job: job[0], reverse=True)
+
+            if batch_settings.gain_mode == GAIN_ALBUM:
+                jobs.append((sum(costs), _process_albums(transcoder, batch_jobs, batch.out_folder, batch.album_tracks)))
+                continue
+
+            for cost, source_track in batch_jobs:
+                job = cost, transcoder, source_track, batch.get_destination_file(source_track)
+
+                if batch_settings.can_share_decode(source_track):
+                    # Треки одного исходного файла для разных профилей перекодируются из одного декодирования.
+                    shared_jobs.setdefault(source_track.source_file, []).append(job)
+                else:
+                    jobs.append((cost, transcoder.process_track(source_track, job[3], cost)))
+
+        for source_jobs in shared_jobs.values():
+            if len(source_jobs) == 1:
+                cost, transcoder, source_track, destination_file = source_jobs[0]
+                jobs.append((cost, transcoder.process_track(source_track, destination_file, cost)))
+            else:
+                jobs.append((get_shared_cost([cost for cost, _, _, _ in source_jobs]),
+                             process_shared_decode(source_jobs)))
+
+        # Самые долгие треки запускаются первыми, чтобы в конце не ждать один длинный трек на одном ядре.
+        jobs.sort(key=lambda job: job[0], reverse=True)
+        total_cost = sum(cost for cost, _ in jobs)
+
+        if jobs:
+            print(f'Estimated work: {total_cost:.0f}, longest track: {jobs[0][0]:.0f}, '
+                  f'lower bound: {max(total_cost / settings.concurrency, jobs[0][0]):.0f}')
+
+        results = []
+
+        for job_results in await asyncio.gather(*(coroutine for _, coroutine in jobs)):
+            results += job_results if isinstance(job_results, list) else [job_results]
+
+        report.finish(results, runner)
+
+        wall_seconds, utilization = runner.get_utilization()
+        print(f'Wall time: {wall_seconds:.1f} s, process time: {runner.busy_seconds:.1f} s, '
+              f'utilization of {settings.concurrency} slots: {utilization:.0%}')
+
+        if runner.controller is not None:
+            print(f'Adaptive concurrency: {runner.controller.min_seen}..{runner.controller.max_seen}, '
+                  f'final {runner.controller.limiter.limit}')
+
+        return results
+    finally:
+        runner.close()
+        cache.close()
+
+
+def transcode_profiles(profiles, report_folder=None):
+    """
+    Перекодирует треки для нескольких профилей результата за один запуск.
+    Трек, нужный нескольким профилям, декодируется один раз.
+    Перекодируются только новые и изменившиеся треки, остальные берутся из предыдущего запуска.
+
+    :param profiles: Список OutputProfile с разными каталогами результата.
+    :param report_folder: Каталог отчета о запуске, по умолчанию REPORT_FOLDER.
+    :return: Списки результатов обработки перекодированных треков по профилям.
+    """
+    batches = [ProfileBatch(profile) for profile in profiles]
+    report = RunReport()
+    results = asyncio.run(_transcode_profiles(batches, report))
+
+    # Каталоги результата профилей разные, поэтому профиль результата определяется по каталогу.
+    batch_results = {batch.out_folder: [] for batch in batches}
+
+    for result in results:
+        batch_results[result.destination_file.parent].append(result)
+
+    for batch in batches:
+        batch.finish(batch_results[batch.out_folder])
+
+    if results:
+        report.print_summary()
+        print(f'Report: {report.save(report_folder).as_posix()}')
+
+    return [batch_results[batch.out_folder] for batch in batches]
+
+
+def transcode_tracks(source_tracks, out_folder: Path, settings: TranscodeSettings):
+    """
+    Перекодирует треки в каталог результата.
+    Перекодируются только новые и изменившиеся треки, остальные берутся из предыдущего запуска.
+
+    :param source_tracks: Список SourceTrack.
+    :return: Результаты обработки перекодированных треков.
+    """
+    return transcode_profiles([OutputProfile(out_folder, settings, source_tracks)])[0]